@@ -16,5 +16,6 @@ setuptools.setup(
         telefs=telefuse.main:main
     ''',
     install_reqs = required,
+    extras_require={"mount": ["fusepy"]},
     packages=setuptools.find_packages()
 )
\ No newline at end of file
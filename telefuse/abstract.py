@@ -1,5 +1,7 @@
 import abc
+import hashlib
 import os
+import typing
 
 
 class File(abc.ABC):
@@ -16,4 +18,56 @@ class File(abc.ABC):
         pass
     
     def get_size(self) -> int:
-        return os.path.getsize(self.real_path)
\ No newline at end of file
+        return os.path.getsize(self.real_path)
+
+class StreamFile(File):
+    """
+    File read once from async byte stream, e.g. stdin.
+
+    Hash, size and progress are counted while chunks are read, so hash and size are known only after upload,
+    progress reports total as 0 until then.
+    """
+    real_path = "-"
+    
+    def __init__(self, path: str, read: typing.Callable[[int], typing.Awaitable[bytes]], progress: typing.Callable[[int, int], typing.Any] = lambda curr, total: None) -> None:
+        self.path = path
+        self.name = os.path.basename(path)
+        self._read = read
+        self._progress = progress
+        self._hash = hashlib.sha1()
+        self._size = 0
+        self._done = False
+    
+    def progress(self, curr: int, total: int):
+        self._progress(curr, total)
+    
+    async def chunks(self, size: int) -> typing.AsyncIterator[bytes]:
+        """Yields chunks of exactly `size` bytes, except the last one"""
+        buffer = bytearray()
+        while True:
+            data = await self._read(size - len(buffer))
+            if not data:
+                break
+            buffer += data
+            if len(buffer) >= size:
+                yield self._count(bytes(buffer))
+                buffer = bytearray()
+        if buffer:
+            yield self._count(bytes(buffer))
+        self._done = True
+    
+    def _count(self, chunk: bytes) -> bytes:
+        self._hash.update(chunk)
+        self._size += len(chunk)
+        self.progress(self._size, 0)
+        return chunk
+    
+    def get_hash(self) -> str:
+        if not self._done:
+            raise ValueError(f"Stream of {self.path} is not read yet")
+        return self._hash.hexdigest()
+    
+    def get_size(self) -> int:
+        if not self._done:
+            raise ValueError(f"Stream of {self.path} is not read yet")
+        return self._size
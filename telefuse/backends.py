@@ -0,0 +1,476 @@
+from __future__ import annotations
+import abc
+import asyncio
+import contextlib
+import json
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import typing
+from . import abstract
+from . import exceptions
+from . import utils
+
+
+# read_range of telegram needs 1 MiB aligned chunks
+STREAM_CHUNK_SIZE = 1024 * 1024
+# called with (old_id, new_id, path, new_volume) of files moved between tiers
+MovedCallback = typing.Callable[[list[tuple[int, int, str, str | None]]], typing.Awaitable[None]]
+
+
+def file_key(file_id: int, volume: str | None = None) -> str:
+    """Unique key of file, ids are unique only inside volume"""
+    return f"{volume}:{file_id}" if volume else str(file_id)
+
+
+def parse_file_key(key: str) -> tuple[int, str | None]:
+    volume, _, file_id = key.rpartition(":")
+    return int(file_id), volume or None
+
+
+class StorageBackend(abc.ABC):
+    """
+    Storage of file contents and index documents.
+
+    Files are addressed by int ids given by backend on upload, id 0 is empty file.
+    Backend may be split to volumes, e.g. chats of telegram, then file is addressed by
+    its volume and id. Volume `None` is the default one, documents are always stored there.
+    """
+
+    def place(self, path: str) -> str | None:
+        """Volume where file with path should be stored"""
+        return None
+
+    @abc.abstractmethod
+    async def upload_file(self, file: abstract.File, file_id: int | None = None, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        """Stores file, replaces content of `file_id` if it is given"""
+
+    @abc.abstractmethod
+    async def upload_stream(self, file: abstract.StreamFile, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        """Stores stream as new file"""
+
+    @abc.abstractmethod
+    async def download_file(self, file_path: str, file_id: int, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> None:
+        pass
+
+    async def download_stream(self, file_id: int, write: typing.Callable[[bytes], typing.Awaitable], progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> None:
+        """Passes file to `write` chunk by chunk, the next chunk is read while previous one is written"""
+        size = await self.file_size(file_id, volume)
+        offsets = range(0, size, STREAM_CHUNK_SIZE)
+        if not offsets:
+            return
+        next_chunk = asyncio.ensure_future(self.read_range(file_id, 0, STREAM_CHUNK_SIZE, traffic_class, volume))
+        try:
+            for offset in offsets:
+                data = await next_chunk
+                if offset + STREAM_CHUNK_SIZE < size:
+                    next_chunk = asyncio.ensure_future(self.read_range(file_id, offset + STREAM_CHUNK_SIZE, STREAM_CHUNK_SIZE, traffic_class, volume))
+                await write(data)
+                progres(offset + len(data), size)
+        finally:
+            next_chunk.cancel()
+
+    async def copy_file(self, file_id: int, volume: str | None, to_volume: str | None, traffic_class: str = "background") -> int:
+        """Copies file to other volume, returns its id there"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "file")
+            await self.download_file(path, file_id, traffic_class=traffic_class, volume=volume)
+            return await self.upload_file(LocalFile(str(file_id), path), traffic_class=traffic_class, volume=to_volume)
+
+    @abc.abstractmethod
+    async def delete_file(self, file_id: int, volume: str | None = None) -> None:
+        pass
+
+    async def prefetch(self, file_id: int, volume: str | None = None) -> None:
+        """Hint that file will be downloaded soon"""
+
+    @abc.abstractmethod
+    async def read_range(self, file_id: int, offset: int, limit: int, traffic_class: str = "interactive", volume: str | None = None) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    async def file_size(self, file_id: int, volume: str | None = None) -> int:
+        pass
+
+    @abc.abstractmethod
+    async def find_document(self, caption: str, location: str) -> None:
+        """Downloads document saved with `caption` to `location`"""
+
+    @abc.abstractmethod
+    async def load_document(self, doc_id: int, location: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def save_document(self, location: str, caption: str, doc_id: int = 0) -> int:
+        """Stores document from `location`, replaces `doc_id` if it is not 0"""
+
+    async def start(self, on_moved: MovedCallback) -> None:
+        """Starts background work of backend"""
+
+    async def stop(self) -> None:
+        pass
+
+    async def flush(self, on_moved: MovedCallback) -> int:
+        """Finishes background work at once, returns count of moved files"""
+        return 0
+
+
+class LocalFile(abstract.File):
+    def __init__(self, path: str, real_path: str) -> None:
+        self.path = path
+        self.name = os.path.basename(path)
+        self.real_path = real_path
+
+    def progress(self, curr: int, total: int):
+        pass
+
+    def get_hash(self) -> str:
+        return utils.hash_file(self.real_path)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Stores files in directory, e.g. on NAS.
+
+    Every file is `objects/<id>`, ids are random, so several processes may share directory.
+    Documents are files too, ids of last documents by caption are kept in `captions.json`.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self._objects = os.path.join(self.root, "objects")
+        self._captions_path = os.path.join(self.root, "captions.json")
+        os.makedirs(self._objects, exist_ok=True)
+
+    def path(self, file_id: int) -> str:
+        return os.path.join(self._objects, str(file_id))
+
+    def _allocate(self) -> int:
+        while True:
+            file_id = secrets.randbits(48) or 1
+            try:
+                os.close(os.open(self.path(file_id), os.O_CREAT | os.O_EXCL))
+            except FileExistsError:
+                continue
+            return file_id
+
+    def _copy(self, src: str, file_id: int):
+        tmp_path = os.path.join(self._objects, f".{file_id}.tmp")
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, self.path(file_id))
+
+    def _check(self, file_id: int) -> str:
+        path = self.path(file_id)
+        if not os.path.isfile(path):
+            raise exceptions.FileNotFound(f"No file {file_id} in {self.root}")
+        return path
+
+    async def upload_file(self, file: abstract.File, file_id: int | None = None, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        size = file.get_size()
+        if size == 0:
+            return 0
+        if not file_id:
+            file_id = self._allocate()
+        await asyncio.to_thread(self._copy, file.real_path, file_id)
+        progres(size, size)
+        return file_id
+
+    async def upload_stream(self, file: abstract.StreamFile, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        file_id = self._allocate()
+        tmp_path = os.path.join(self._objects, f".{file_id}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in file.chunks(STREAM_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            await self.delete_file(file_id)
+            raise
+        if file.get_size() == 0:
+            os.remove(tmp_path)
+            await self.delete_file(file_id)
+            return 0
+        os.replace(tmp_path, self.path(file_id))
+        return file_id
+
+    async def download_file(self, file_path: str, file_id: int, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> None:
+        if file_id == 0:
+            if not os.path.exists(file_path):
+                open(file_path, 'x').close()
+            return
+        path = self._check(file_id)
+        dir_path = os.path.dirname(file_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        await asyncio.to_thread(shutil.copyfile, path, file_path)
+        size = os.path.getsize(file_path)
+        progres(size, size)
+
+    async def delete_file(self, file_id: int, volume: str | None = None) -> None:
+        if file_id == 0:
+            return
+        try:
+            os.remove(self.path(file_id))
+        except FileNotFoundError:
+            pass
+
+    async def read_range(self, file_id: int, offset: int, limit: int, traffic_class: str = "interactive", volume: str | None = None) -> bytes:
+        def read() -> bytes:
+            with open(self._check(file_id), "rb") as f:
+                f.seek(offset)
+                return f.read(limit)
+        return await asyncio.to_thread(read)
+
+    async def file_size(self, file_id: int, volume: str | None = None) -> int:
+        return os.path.getsize(self._check(file_id)) if file_id else 0
+
+    def _captions(self) -> dict[str, int]:
+        try:
+            with open(self._captions_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    async def find_document(self, caption: str, location: str) -> None:
+        doc_id = self._captions().get(caption)
+        if doc_id is None:
+            raise exceptions.WrongIndexException(f"Can not find document {caption} in {self.root}")
+        await self.load_document(doc_id, location)
+
+    async def load_document(self, doc_id: int, location: str) -> None:
+        try:
+            shutil.copyfile(self._check(doc_id), location)
+        except exceptions.FileNotFound:
+            raise exceptions.WrongIndexException(f"Can not find document {doc_id} in {self.root}")
+
+    async def save_document(self, location: str, caption: str, doc_id: int = 0) -> int:
+        if not doc_id:
+            doc_id = self._allocate()
+        self._copy(location, doc_id)
+        captions = self._captions()
+        if captions.get(caption) != doc_id:
+            captions[caption] = doc_id
+            tmp_path = self._captions_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(captions, f)
+            os.replace(tmp_path, self._captions_path)
+        return doc_id
+
+
+class TieredBackend(StorageBackend):
+    """
+    Write-back of local tier to remote one.
+
+    Uploads are stored in local tier and get negative pending ids at once, background task
+    drains them to remote tier and reports new ids with `on_moved`, so owner may fix its index.
+    Drained files stay in local tier and are read from there. Pending ids are resolved to remote
+    ones later too, so old snapshots still can be read. Documents are stored in remote tier only.
+    State is kept in `tiered.json` of local tier, so draining continues after restart.
+    """
+
+    def __init__(self, local: LocalBackend, remote: StorageBackend, max_inflight: int = 4) -> None:
+        self.local = local
+        self.remote = remote
+        self.max_inflight = max_inflight
+        self._state_path = os.path.join(local.root, "tiered.json")
+        self.pending: dict[int, dict[str, typing.Any]] = {}
+        # file key of remote file -> local id of drained files
+        self.cached: dict[str, int] = {}
+        # pending id -> remote id and volume
+        self.aliases: dict[int, tuple[int, str | None]] = {}
+        self._load_state()
+        self._wakeup = asyncio.Event()
+        self._drain_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def _load_state(self):
+        try:
+            with open(self._state_path, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        # state of single chat version has no volumes, its files are in default one
+        self.pending = {int(key): {"volume": None} | value for key, value in state["pending"].items()}
+        self.cached = state["cached"]
+        self.aliases = {
+            int(key): tuple(value) if isinstance(value, list) else (value, None)
+            for key, value in state["aliases"].items()
+        }
+
+    def _save_state(self):
+        tmp_path = self._state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"pending": self.pending, "cached": self.cached, "aliases": self.aliases}, f)
+        os.replace(tmp_path, self._state_path)
+
+    def place(self, path: str) -> str | None:
+        return self.remote.place(path)
+
+    def _resolve(self, file_id: int, volume: str | None) -> tuple[int, str | None]:
+        return self.aliases.get(file_id, (file_id, volume))
+
+    def _local_id(self, file_id: int, volume: str | None) -> int | None:
+        if file_id < 0:
+            return -file_id
+        return self.cached.get(file_key(file_id, volume))
+
+    async def upload_file(self, file: abstract.File, file_id: int | None = None, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        target = None
+        if file_id:
+            target, volume = self._resolve(file_id, volume)
+        if target is not None and target < 0:
+            # replaced before it was drained, so old content is not uploaded at all
+            old_id = target
+            entry = self.pending.pop(old_id, {"target": None, "volume": volume})
+            target, volume = entry["target"], entry["volume"]
+            await self.local.delete_file(-old_id)
+        local_id = await self.local.upload_file(file, progres=progres)
+        if local_id == 0:
+            self._save_state()
+            return 0
+        return self._add_pending(-local_id, file.path, target, volume)
+
+    async def upload_stream(self, file: abstract.StreamFile, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        local_id = await self.local.upload_stream(file)
+        if local_id == 0:
+            return 0
+        return self._add_pending(-local_id, file.path, None, volume)
+
+    def _add_pending(self, pending_id: int, path: str, target: int | None, volume: str | None) -> int:
+        self.pending[pending_id] = {"path": path, "target": target, "volume": volume}
+        self._save_state()
+        self._wakeup.set()
+        return pending_id
+
+    async def download_file(self, file_path: str, file_id: int, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> None:
+        file_id, volume = self._resolve(file_id, volume)
+        local_id = self._local_id(file_id, volume)
+        if local_id is not None:
+            await self.local.download_file(file_path, local_id, progres)
+        else:
+            await self.remote.download_file(file_path, file_id, progres, traffic_class, volume)
+
+    async def copy_file(self, file_id: int, volume: str | None, to_volume: str | None, traffic_class: str = "background") -> int:
+        file_id, volume = self._resolve(file_id, volume)
+        if file_id < 0:
+            # pending file is not uploaded yet, so its copy is just pending for other volume
+            entry = self.pending.get(file_id)
+            if entry is None:
+                raise exceptions.FileNotFound(f"No pending file {file_id}")
+            local_id = await self.local.upload_file(LocalFile(entry["path"], self.local.path(-file_id)))
+            return self._add_pending(-local_id, entry["path"], None, to_volume)
+        remote_id = await self.remote.copy_file(file_id, volume, to_volume, traffic_class)
+        local_id = self._local_id(file_id, volume)
+        if local_id is not None:
+            self.cached[file_key(remote_id, to_volume)] = await self.local.upload_file(LocalFile(str(remote_id), self.local.path(local_id)))
+            self._save_state()
+        return remote_id
+
+    async def delete_file(self, file_id: int, volume: str | None = None) -> None:
+        file_id, volume = self._resolve(file_id, volume)
+        if file_id < 0:
+            entry = self.pending.pop(file_id, None)
+            await self.local.delete_file(-file_id)
+            if entry is not None and entry["target"]:
+                await self._delete_drained(entry["target"], entry["volume"])
+        else:
+            await self._delete_drained(file_id, volume)
+        self._save_state()
+
+    async def _delete_drained(self, file_id: int, volume: str | None):
+        local_id = self.cached.pop(file_key(file_id, volume), None)
+        if local_id is not None:
+            await self.local.delete_file(local_id)
+        await self.remote.delete_file(file_id, volume)
+
+    async def prefetch(self, file_id: int, volume: str | None = None) -> None:
+        file_id, volume = self._resolve(file_id, volume)
+        if self._local_id(file_id, volume) is None:
+            await self.remote.prefetch(file_id, volume)
+
+    async def read_range(self, file_id: int, offset: int, limit: int, traffic_class: str = "interactive", volume: str | None = None) -> bytes:
+        file_id, volume = self._resolve(file_id, volume)
+        local_id = self._local_id(file_id, volume)
+        if local_id is not None:
+            return await self.local.read_range(local_id, offset, limit)
+        return await self.remote.read_range(file_id, offset, limit, traffic_class, volume)
+
+    async def file_size(self, file_id: int, volume: str | None = None) -> int:
+        file_id, volume = self._resolve(file_id, volume)
+        local_id = self._local_id(file_id, volume)
+        if local_id is not None:
+            return await self.local.file_size(local_id)
+        return await self.remote.file_size(file_id, volume)
+
+    async def find_document(self, caption: str, location: str) -> None:
+        await self.remote.find_document(caption, location)
+
+    async def load_document(self, doc_id: int, location: str) -> None:
+        await self.remote.load_document(doc_id, location)
+
+    async def save_document(self, location: str, caption: str, doc_id: int = 0) -> int:
+        return await self.remote.save_document(location, caption, doc_id)
+
+    async def _drain_one(self, semaphore: asyncio.Semaphore, pending_id: int, entry: dict[str, typing.Any]) -> tuple[int, int, str, str | None] | None:
+        async with semaphore:
+            local_file = LocalFile(entry["path"], self.local.path(-pending_id))
+            remote_id = await self.remote.upload_file(local_file, file_id=entry["target"], traffic_class="background", volume=entry["volume"])
+        if self.pending.pop(pending_id, None) is None:
+            # deleted or replaced while it was uploaded
+            if remote_id != entry["target"]:
+                await self.remote.delete_file(remote_id, entry["volume"])
+            return None
+        # file replaced in place has old content in local tier under the same key
+        stale = self.cached.get(file_key(remote_id, entry["volume"]))
+        self.cached[file_key(remote_id, entry["volume"])] = -pending_id
+        if stale is not None and stale != -pending_id:
+            await self.local.delete_file(stale)
+        self.aliases[pending_id] = (remote_id, entry["volume"])
+        return pending_id, remote_id, entry["path"], entry["volume"]
+
+    async def flush(self, on_moved: MovedCallback) -> int:
+        async with self._drain_lock:
+            semaphore = asyncio.Semaphore(self.max_inflight)
+            results = await asyncio.gather(
+                *(self._drain_one(semaphore, pending_id, entry) for pending_id, entry in list(self.pending.items())),
+                return_exceptions=True
+            )
+            self._save_state()
+            moves = [res for res in results if isinstance(res, tuple)]
+            if moves:
+                await on_moved(moves)
+            for res in results:
+                if isinstance(res, Exception):
+                    raise res
+            return len(moves)
+
+    async def _drain_coro(self, on_moved: MovedCallback):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self.flush(on_moved)
+            except Exception as e:
+                # stdout may be taken by data, e.g. of `telefs cat`
+                print(f"Cannot drain files to remote tier: {e}", file=sys.stderr)
+                await asyncio.sleep(30)
+                self._wakeup.set()
+
+    async def start(self, on_moved: MovedCallback) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._drain_coro(on_moved))
+            if self.pending:
+                self._wakeup.set()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
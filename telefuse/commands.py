@@ -1,42 +1,110 @@
+from __future__ import annotations
 import abc
 import argparse
 import asyncio
 from . import config
 import typing
 from . import telegram
-import pyrogram
+from . import backends
 from . import exceptions
 from . import abstract
 import os
 import json
-from . import config
 from . import utils
-from .wather import Wather
+from . import tree
+from . import ignore
+from . import shaping
 import signal
+import sys
+import time
+from pathlib import Path
+
+if typing.TYPE_CHECKING:
+    import pyrogram
 
 
 class ProgressBar:
-    def __init__(self, length: int = 10, decimal: int = 10, name: str = "uploading"):
+    """
+    Aggregates transfer progress of many files and redraws it at a fixed rate.
+
+    `print` is called from pyrogram progress callbacks, so it only updates counters;
+    the actual output is made by renderer task started with `async with`.
+    In `json` mode (default for non-tty output) every redraw is a single JSON line.
+    """
+    def __init__(self, length: int = 10, decimal: int = 10, name: str = "uploading", mode: str = "auto", rate: float = 5, output: typing.TextIO | None = None):
         self.files: dict[str, tuple[int, int]] = {}
         self.sum: int = 0
         self.total_sum: int = 0
         self.length: int = length
         self.decimal: int = decimal
         self.name = name
+        self.last_file: str = ""
+        self.output = output if output is not None else sys.stdout
+        self.mode = mode if mode != "auto" else ("bar" if self.output.isatty() else "json")
+        self.period = 1 / rate
+        self._dirty = False
+        self._line_open = False
+        self._renderer: asyncio.Task | None = None
     
     def print(self, filename: str, curr: int, total: int):
-        self.total_sum -= self.files.get(filename, (0, 0))[1]
-        self.sum -= self.files.get(filename, (0, 0))[0]
-        self.total_sum += total
-        self.sum += curr
+        prev_curr, prev_total = self.files.get(filename, (0, 0))
         self.files[filename] = (curr, total)
-        utils.printProgressBar(
-            iteration=self.sum,
-            total=self.total_sum,
-            suffix=f"{self.name} {filename} {self.sum}/{self.total_sum}",
-            length=self.length,
-            decimals=self.decimal,
-        )
+        self.sum += curr - prev_curr
+        self.total_sum += total - prev_total
+        self.last_file = filename
+        self._dirty = True
+    
+    def render(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        match self.mode:
+            case "json":
+                print(json.dumps({
+                    "name": self.name,
+                    "file": self.last_file,
+                    "done": self.sum,
+                    "total": self.total_sum,
+                    "files": len(self.files),
+                }), flush=True, file=self.output)
+            case "bar" if self.total_sum == 0 and self.sum:
+                # size of stream is unknown until it is read
+                print(f"\r{self.name} {self.last_file} {self.sum}/?", end="", file=self.output)
+                self._line_open = True
+            case "bar":
+                utils.printProgressBar(
+                    iteration=self.sum,
+                    total=self.total_sum,
+                    suffix=f"{self.name} {self.last_file} {self.sum}/{self.total_sum}",
+                    length=self.length,
+                    decimals=self.decimal,
+                    file=self.output,
+                )
+                self._line_open = self.sum != self.total_sum
+    
+    async def _render_coro(self):
+        while True:
+            await asyncio.sleep(self.period)
+            self.render()
+    
+    async def __aenter__(self) -> "ProgressBar":
+        if self.mode != "none" and self._renderer is None:
+            self._renderer = asyncio.create_task(self._render_coro())
+        return self
+    
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        if self._renderer is None:
+            return
+        self._renderer.cancel()
+        try:
+            await self._renderer
+        except asyncio.CancelledError:
+            pass
+        self._renderer = None
+        self.render()
+        if self._line_open:
+            print(file=self.output)
+            self._line_open = False
 
 
 class File(abstract.File):
@@ -54,14 +122,28 @@ class File(abstract.File):
 
 
 class Command(abc.ABC):
+    daemon_capable: bool = False
     
-    def __init__(self, client: pyrogram.Client, parser: argparse._SubParsersAction, app_config: config.AppConfig, fs_config: config.FsConfig | None) -> None:
+    def __init__(self, client_factory: typing.Callable[[], pyrogram.Client], parser: argparse._SubParsersAction, app_config: config.AppConfig, fs_config: config.FsConfig | None) -> None:
         async def exec(args: argparse.Namespace):
+            if self.daemon_capable and fs_config is not None and not args.no_daemon:
+                try:
+                    return await self.run_in_daemon(args, fs_config)
+                except exceptions.DaemonNotRunning:
+                    pass
+            if not self.needs_client(args, fs_config):
+                return await self.run(None, args, app_config, fs_config)
+            client = client_factory()
             async with client:
                 return await self.run(client, args, app_config, fs_config)
         pars = self.edit_argparser(parser)
         pars.set_defaults(func=exec)
     
+    @classmethod
+    def needs_client(cls, args: argparse.Namespace, fs_config: config.FsConfig | None) -> bool:
+        # found index with local backend does not need telegram at all
+        return fs_config is None or fs_config.backend != "local"
+    
     @classmethod
     @abc.abstractclassmethod
     def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
@@ -69,11 +151,36 @@ class Command(abc.ABC):
     
     @classmethod
     @abc.abstractclassmethod
-    async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+    async def run(cls, client: pyrogram.Client | None, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         pass
+    
+    @classmethod
+    async def run_in_daemon(cls, args: argparse.Namespace, fs_config: config.FsConfig):
+        raise exceptions.DaemonNotRunning
+
+
+def open_backend(client: pyrogram.Client | None, fs_config: config.FsConfig) -> backends.StorageBackend:
+    match fs_config.backend:
+        case "local":
+            return backends.LocalBackend(fs_config.storage_path)
+        case "tiered":
+            return backends.TieredBackend(
+                backends.LocalBackend(fs_config.storage_path),
+                telegram.TelegramBackend(telegram.TelegramApi(client), client, fs_config.chat_id, fs_config.storage_chats)
+            )
+        case _:
+            return telegram.TelegramBackend(telegram.TelegramApi(client), client, fs_config.chat_id, fs_config.storage_chats)
+
 
+async def open_fs(client: pyrogram.Client | None, fs_config: config.FsConfig, offline: bool = False, paths: typing.Iterable[str] | None = None) -> telegram.TelegramFileSystem:
+    """Opens fs with index shards of remote `paths` loaded, all of them by default"""
+    location = os.path.join(fs_config.dir_path, '.telefs_index')
+    if offline:
+        return telegram.TelegramFileSystem.offline(location)
+    return await telegram.TelegramFileSystem.with_backend(open_backend(client, fs_config), fs_config.index_name, location, paths)
 
-def init_commands(client: pyrogram.Client, parser: argparse._SubParsersAction, app_config: config.AppConfig, fs_config: config.FsConfig | None) -> list[Command]:
+
+def init_commands(client_factory: typing.Callable[[], pyrogram.Client], parser: argparse._SubParsersAction, app_config: config.AppConfig, fs_config: config.FsConfig | None) -> list[Command]:
     
     commands: list[typing.Type[Command]] = [
         Get,
@@ -84,11 +191,21 @@ def init_commands(client: pyrogram.Client, parser: argparse._SubParsersAction, a
         Status,
         Download,
         Upload,
-        Wath
+        Wath,
+        Ls,
+        Du,
+        Daemon,
+        Mount,
+        Snapshot,
+        Limit,
+        Flush,
+        Put,
+        Cat,
+        Rebalance,
     ]
     
     return [
-        command(client, parser, app_config, fs_config) for command in commands
+        command(client_factory, parser, app_config, fs_config) for command in commands
     ]
 
 
@@ -96,7 +213,11 @@ class FileCommand(Command, abc.ABC):
     command_name: str | None = None
     command_help: str | None = None
     must_exist: bool = True
+    # files must be in index, e.g. to be downloaded
+    must_be_indexed: bool = False
     expect_dirs: bool = False
+    expect_remote_dirs: bool = False
+    daemon_capable = True
     
     @classmethod
     def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
@@ -111,40 +232,58 @@ class FileCommand(Command, abc.ABC):
     async def exec(cls, client: pyrogram.Client, file_path:str, app_config: config.AppConfig, fs_config: config.FsConfig, operation: telegram.OperationCtx, pb: ProgressBar):
         pass
     
+    @classmethod
+    async def expand_files(cls, fs: telegram.TelegramFileSystem, fs_config: config.FsConfig, paths: typing.Iterable[str], matcher: ignore.IgnoreMatcher) -> set[str]:
+        files: set[str] = set()
+        for file_path in {os.path.abspath(path) for path in paths}:
+            expanded = False
+            if cls.expect_remote_dirs:
+                node = fs.tree.find(fs_config.get_path(file_path))
+                if isinstance(node, tree.DirNode):
+                    expanded = True
+                    files |= {os.path.join(fs_config.dir_path, f.path) for f in node.walk()}
+            if cls.expect_dirs and os.path.isdir(file_path):
+                expanded = True
+                # scan waits for its thread pool, so it is kept off event loop
+                files.update((await asyncio.to_thread(ignore.scan, file_path, fs_config.dir_path, matcher))[0])
+            if not expanded:
+                files.add(file_path)
+        files.discard(os.path.join(fs_config.dir_path, '.telefs_index'))
+        files.discard(os.path.join(fs_config.dir_path, '.telefs'))
+        if cls.must_exist:
+            for file_path in files:
+                if not os.path.exists(file_path):
+                    raise exceptions.CommandValidationError(f"File {file_path} is not walid")
+        if cls.must_be_indexed:
+            for file_path in files:
+                if fs.get_file_from_local_index(fs_config.get_path(file_path)) is None:
+                    raise exceptions.FileNotFound(f"No file {fs_config.get_path(file_path)} in index")
+        return files
+    
     @classmethod
     async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         if fs_config is None:
             raise exceptions.WrongIndexException("Index not found, but must be specified. Run init command to create new index")
-        fs = await telegram.TelegramFileSystem.with_telegram_api(
-            telegram.TelegramApi(client),
-            client,
-            fs_config.chat_id,
-            fs_config.index_name,
-            os.path.join(fs_config.dir_path, '.telefs_index')
-        )
+        fs = await open_fs(client, fs_config, paths=remote_paths(args.files, fs_config))
         
-        progress_bar = ProgressBar()
-        
-        files = {os.path.abspath(file) for file in args.files}
-        if cls.expect_dirs:
-            for file_path in files.copy():
-                if os.path.exists(file_path) and os.path.isdir(file_path):
-                    files.remove(file_path)
-                    for dirpath, dirnames, filenames in os.walk(file_path):
-                        files = files | {
-                            os.path.join(file_path, dirpath, filename)
-                            for filename in filenames
-                        }
-        files.remove(os.path.join(fs_config.dir_path, '.telefs_index'))
-        files.remove(os.path.join(fs_config.dir_path, '.telefs'))
-        async with fs.operation() as op:
+        progress_bar = ProgressBar(mode=args.progress)
+        
+        files = await cls.expand_files(fs, fs_config, args.files, ignore.IgnoreMatcher.load(fs_config.dir_path))
+        async with progress_bar, fs.operation() as op:
             for file_path in files:
-                if cls.must_exist and not os.path.exists(file_path):
-                    raise exceptions.CommandValidationError(f"File {file_path} is not walid")
                 await cls.exec(
                     client, file_path, app_config, fs_config, op, progress_bar
                 )
     
+    @classmethod
+    async def run_in_daemon(cls, args: argparse.Namespace, fs_config: config.FsConfig):
+        from . import daemon
+        await daemon.request({
+            "command": cls.command_name,
+            "dir_path": fs_config.dir_path,
+            "files": [os.path.abspath(file) for file in args.files],
+        })
+    
     
 class Add(FileCommand):
     command_name = "add"
@@ -158,8 +297,10 @@ class Add(FileCommand):
 
 class Get(FileCommand):
     command_name = "get"
-    command_help = "Get file from telegram"
+    command_help = "Get file or directory from telegram"
     must_exist = False
+    must_be_indexed = True
+    expect_remote_dirs = True
     
     @classmethod
     async def exec(cls, client: pyrogram.Client, file_path: str, app_config: config.AppConfig, fs_config: config.FsConfig, operation: telegram.OperationCtx, pb: ProgressBar):
@@ -171,12 +312,18 @@ class Rm(FileCommand):
     command_help = "Remove file from telegram"
     must_exist = False
     expect_dirs = True
+    expect_remote_dirs = True
     
     @classmethod
     async def exec(cls, client: pyrogram.Client, file_path: str, app_config: config.AppConfig, fs_config: config.FsConfig, operation: telegram.OperationCtx, pb: ProgressBar):
         operation.delete(File(fs_config.get_path(file_path), file_path, pb))
 
 
+FILE_COMMANDS: dict[str, typing.Type[FileCommand]] = {
+    command.command_name: command for command in (Add, Get, Rm)
+}
+
+
 class IndexEditingCommand(Command, abc.ABC):
     flags: dict[str, dict[str, typing.Any]] = {}
     command_name: str | None = None
@@ -209,17 +356,36 @@ class Init(Command):
         arg = parser.add_parser("init", description="Init index here")
         arg.add_argument("index_name", help="Name of new fs")
         arg.add_argument("--id", help="Id of chat to add index to, may be username", default="me")
+        arg.add_argument(
+            "--backend", help="Where to store files: telegram chat, local directory e.g. on NAS, "
+            "or local directory drained to telegram in background", choices=config.BACKENDS, default="telegram"
+        )
+        arg.add_argument("--storage", help="Directory of local and tiered backends")
+        arg.add_argument(
+            "--storage-chat", help="Chat to stripe files across, may be repeated, chat of index is not used unless given",
+            action="append", default=[], dest="storage_chats", metavar="CHAT"
+        )
         return arg
     
     @classmethod
-    async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+    def needs_client(cls, args: argparse.Namespace, fs_config: config.FsConfig | None) -> bool:
+        # new index may be nested in index of other backend
+        return args.backend != "local"
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client | None, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         if fs_config and os.path.abspath(os.getcwd()) == fs_config.dir_path:
             raise exceptions.CommandValidationError("Index already exists")
+        if args.backend != "telegram" and args.storage is None:
+            raise exceptions.CommandValidationError(f"--storage is required for {args.backend} backend")
         fs_config = config.FsConfig(
-            session=client.session_name,
+            session=client.session_name if client is not None else os.path.join(Path.home(), ".telefs_session"),
             index_name=args.index_name,
             chat_id=args.id,
-            dir_path=os.path.abspath(os.getcwd())
+            dir_path=os.path.abspath(os.getcwd()),
+            backend=args.backend,
+            storage_path=os.path.abspath(args.storage) if args.storage is not None else None,
+            storage_chats=args.storage_chats
         )
         
         with open(os.path.join(os.getcwd(), config.FS_FILE_NAME), "w") as f:
@@ -229,7 +395,7 @@ class Init(Command):
             index_name=args.index_name,
             files={}
         )
-        await index.save(client, args.id, os.path.join(os.path.abspath(os.getcwd()), ".telefs_index"))
+        await index.save(open_backend(client, fs_config), os.path.join(os.path.abspath(os.getcwd()), ".telefs_index"))
 
 
 class Clone(Command):
@@ -243,6 +409,11 @@ class Clone(Command):
         arg.add_argument("--to_id", help="Id of chat to add index to, may be username", default="me")
         return arg
     
+    @classmethod
+    def needs_client(cls, args: argparse.Namespace, fs_config: config.FsConfig | None) -> bool:
+        # index is cloned from telegram, whatever backend of enclosing index is
+        return True
+    
     @classmethod
     async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         if fs_config and os.path.abspath(os.getcwd()) == fs_config.dir_path:
@@ -255,10 +426,11 @@ class Clone(Command):
             client, args.from_id, args.old_index_name,
             os.path.join(os.path.abspath(os.getcwd()), '.telefs_index')
         )
+        new_backend = telegram.TelegramBackend(telegram_api, client, args.to_id)
         
-        progress_bar = ProgressBar()
+        progress_bar = ProgressBar(name="Downloading", mode=args.progress)
         
-        async with old_fs.operation() as op:
+        async with progress_bar, old_fs.operation() as op:
             for file_name in old_fs.files:
                 op.get(File(file_name, os.path.join(os.path.abspath(os.getcwd()), file_name), progress_bar))
         
@@ -267,7 +439,7 @@ class Clone(Command):
             files={}
         )
 
-        await new_index.save(client, args.to_id, os.path.join(os.path.abspath(os.getcwd()), ".telefs_index"))
+        await new_index.save(new_backend, os.path.join(os.path.abspath(os.getcwd()), ".telefs_index"))
         
         fs_config = config.FsConfig(
             session=client.session_name,
@@ -280,28 +452,26 @@ class Clone(Command):
             json.dump(fs_config.dict(), f)
         
         new_fs = telegram.TelegramFileSystem(
-            telegram_api,
+            new_backend,
             new_index,
-            args.to_id,
-            client,
             os.path.join(os.path.abspath(os.getcwd()), '.telefs_index')
         )
         
-        progress_bar = ProgressBar()
+        progress_bar = ProgressBar(mode=args.progress)
         
-        async with new_fs.operation() as op:
+        async with progress_bar, new_fs.operation() as op:
             for file_name in old_fs.files:
                 op.add(File(file_name, fs_config.get_path(file_name), progress_bar))
 
 
-def get_differs_files(fs: telegram.TelegramFileSystem, fs_config: config.FsConfig) -> tuple[set[str], set[str]]:
+def get_differs_files(fs: telegram.TelegramFileSystem, fs_config: config.FsConfig, paths: typing.Iterable[str] = ("",), matcher: ignore.IgnoreMatcher | None = None) -> tuple[set[str], set[str]]:
     differs = set()
     deleted = set()
     
-    for filepath in fs.files:
-        telegram_file = fs.get_file_from_local_index(filepath)
-        if telegram_file is None:
-            raise exceptions.CommandValidationError("Internal error: Cannot be raised")
+    telegram_files = {f.path: f for path in paths for f in fs.walk(path)}
+    for filepath, telegram_file in telegram_files.items():
+        if matcher is not None and matcher.is_ignored(filepath):
+            continue
         current_filepath = os.path.join(fs_config.dir_path, filepath)
         if not os.path.exists(current_filepath):
             deleted.add(filepath)
@@ -311,30 +481,49 @@ def get_differs_files(fs: telegram.TelegramFileSystem, fs_config: config.FsConfi
     return differs, deleted
 
 
-class Status(Command):
+class OfflineCommand(Command, abc.ABC):
+    """Command that may be answered from the local copy of index with --offline"""
+    
+    @classmethod
+    def add_offline_flag(cls, arg: argparse.ArgumentParser):
+        arg.add_argument("--offline", help="Use local copy of index, do not connect to telegram", action="store_true")
+    
+    @classmethod
+    def offline(cls, args: argparse.Namespace) -> bool:
+        return args.offline
+    
+    @classmethod
+    def needs_client(cls, args: argparse.Namespace, fs_config: config.FsConfig | None) -> bool:
+        return not cls.offline(args) and super().needs_client(args, fs_config)
+
+
+def remote_paths(paths: list[str], fs_config: config.FsConfig) -> list[str]:
+    return [fs_config.get_path(os.path.abspath(path)) for path in paths] or [fs_config.get_path(os.getcwd())]
+
+
+class Status(OfflineCommand):
     @classmethod
     def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
         arg = parser.add_parser("status", description="Get status of current index")
+        arg.add_argument("paths", help="Show status only for these files or directories", nargs="*")
+        cls.add_offline_flag(arg)
         return arg
     
     @classmethod
     async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         if fs_config is None:
             raise exceptions.WrongIndexException("Index not found")
-        fs = await telegram.TelegramFileSystem.with_telegram_api(
-            telegram.TelegramApi(client),
-            client,
-            fs_config.chat_id,
-            fs_config.index_name,
-            os.path.join(fs_config.dir_path, '.telefs_index')
-        )
+        paths = remote_paths(args.paths, fs_config) if args.paths else [""]
+        fs = await open_fs(client, fs_config, offline=cls.offline(args), paths=paths)
         
         print(f"Currently in index `{fs_config.index_name}`:")
         print(f"    Chat id: `{fs_config.chat_id}`")
         print(f"    Working directory: `{fs_config.dir_path}`")
         print(f"    Session in file: {fs_config.session}")
+        if fs_config.backend != "telegram":
+            print(f"    Backend: {fs_config.backend} in `{fs_config.storage_path}`")
         
-        differs, deleted = get_differs_files(fs, fs_config)
+        differs, deleted = get_differs_files(fs, fs_config, paths, ignore.IgnoreMatcher.load(fs_config.dir_path))
            
         if not differs and not deleted:
             print("\nAll files are up-to-date")
@@ -361,17 +550,11 @@ class Download(Command):
     async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         if fs_config is None:
             raise exceptions.WrongIndexException("Index not found")
-        fs = await telegram.TelegramFileSystem.with_telegram_api(
-            telegram.TelegramApi(client),
-            client,
-            fs_config.chat_id,
-            fs_config.index_name,
-            os.path.join(fs_config.dir_path, '.telefs_index')
-        )
+        fs = await open_fs(client, fs_config)
         differs, deleted = get_differs_files(fs, fs_config)
         
-        pb = ProgressBar(name="Syncing")
-        async with fs.operation() as op:
+        pb = ProgressBar(name="Syncing", mode=args.progress)
+        async with pb, fs.operation() as op:
             for filepath in differs | deleted:
                 current_path = os.path.join(fs_config.dir_path, filepath)
                 f = File(filepath, current_path, pb)
@@ -388,17 +571,11 @@ class Upload(Command):
     async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         if fs_config is None:
             raise exceptions.WrongIndexException("Index not found")
-        fs = await telegram.TelegramFileSystem.with_telegram_api(
-            telegram.TelegramApi(client),
-            client,
-            fs_config.chat_id,
-            fs_config.index_name,
-            os.path.join(fs_config.dir_path, '.telefs_index')
-        )
-        differs, deleted = get_differs_files(fs, fs_config)
+        fs = await open_fs(client, fs_config)
+        differs, deleted = get_differs_files(fs, fs_config, matcher=ignore.IgnoreMatcher.load(fs_config.dir_path))
         
-        pb = ProgressBar(name="Uploading")
-        async with fs.operation() as op:
+        pb = ProgressBar(name="Uploading", mode=args.progress)
+        async with pb, fs.operation() as op:
             for filepath in differs:
                 current_path = os.path.join(fs_config.dir_path, filepath)
                 f = File(filepath, current_path, pb)
@@ -421,25 +598,400 @@ class Wath(Command):
     async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
         if fs_config is None:
             raise exceptions.WrongIndexException("Index not found")
-        fs = await telegram.TelegramFileSystem.with_telegram_api(
-            telegram.TelegramApi(client),
-            client,
-            fs_config.chat_id,
-            fs_config.index_name,
-            os.path.join(fs_config.dir_path, '.telefs_index')
-        )
+        fs = await open_fs(client, fs_config)
+        
+        pb = ProgressBar(mode=args.progress)
         
-        pb = ProgressBar()
+        from .wather import Wather
         
         def file_factory(path: str) -> File:
             return File(fs_config.get_path(path), path, pb)
 
-        wather = Wather(fs, file_factory)
+        wather = Wather(fs, file_factory, ignore.IgnoreMatcher.load(fs_config.dir_path))
         
-        client.loop.add_signal_handler(
+        asyncio.get_running_loop().add_signal_handler(
             signal.SIGINT, lambda: asyncio.create_task(wather.stop())
         )
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, shaping.shaper().reload)
+        
+        async with pb:
+            await fs.start()
+            try:
+                await wather.start_and_wait(fs_config.dir_path, fs_config)
+            finally:
+                await fs.stop()
+
+
+class Ls(OfflineCommand):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser("ls", description="List remote directory")
+        arg.add_argument("paths", help="Remote directories to list, current one by default", nargs="*")
+        cls.add_offline_flag(arg)
+        return arg
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client | None, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        fs = await open_fs(client, fs_config, offline=cls.offline(args), paths=remote_paths(args.paths, fs_config))
         
-        await wather.start_and_wait(fs_config.dir_path, fs_config)
+        for path in remote_paths(args.paths, fs_config):
+            node = fs.tree.find(path)
+            if node is None:
+                raise exceptions.FileNotFound(f"No file {path} in index")
+            if not isinstance(node, tree.DirNode):
+                print(f"{utils.format_size(node.size):>10}  {node.path}")
+                continue
+            if len(args.paths) > 1:
+                print(f"{path}:")
+            for name, dirnode in sorted(node.dirs.items()):
+                print(f"{utils.format_size(dirnode.size):>10}  {name}/ ({dirnode.count} files)")
+            for name, f in sorted(node.files.items()):
+                print(f"{utils.format_size(f.size):>10}  {name}")
+
+
+class Du(OfflineCommand):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser("du", description="Show size and files count of remote directories")
+        arg.add_argument("paths", help="Remote files or directories, current one by default", nargs="*")
+        arg.add_argument("--depth", "-d", help="Show also subdirectories up to this depth", type=int, default=0)
+        cls.add_offline_flag(arg)
+        return arg
+    
+    @classmethod
+    def print_node(cls, node: tree.DirNode, path: str, depth: int):
+        if depth > 0:
+            for name, dirnode in sorted(node.dirs.items()):
+                cls.print_node(dirnode, os.path.normpath(os.path.join(path, name)), depth - 1)
+        print(f"{utils.format_size(node.size):>10}  {node.count:>8}  {path}")
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client | None, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        fs = await open_fs(client, fs_config, offline=cls.offline(args), paths=remote_paths(args.paths, fs_config))
         
-    
\ No newline at end of file
+        for path in remote_paths(args.paths, fs_config):
+            node = fs.tree.find(path)
+            if node is None:
+                raise exceptions.FileNotFound(f"No file {path} in index")
+            if not isinstance(node, tree.DirNode):
+                print(f"{utils.format_size(node.size):>10}  {1:>8}  {node.path}")
+                continue
+            cls.print_node(node, path, args.depth)
+
+
+class Daemon(Command):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser(
+            "daemon",
+            description="Keep telegram sessions, indexes and watchers of working directories warm. "
+            "While it is running add, get and rm are executed by daemon"
+        )
+        arg.add_argument("dirs", help="Working directories to load on start, others are loaded on first request", nargs="*")
+        arg.add_argument("--window", help="Seconds to collect concurrent requests into one batch", type=float, default=0.1)
+        arg.add_argument("--stop", help="Stop running daemon", action="store_true")
+        return arg
+    
+    @classmethod
+    def needs_client(cls, args: argparse.Namespace, fs_config: config.FsConfig | None) -> bool:
+        return False
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client | None, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        from . import daemon
+        if args.stop:
+            await daemon.request({"command": "stop"})
+            return
+        server = daemon.Server(app_config, window=args.window)
+        await server.serve([os.path.abspath(path) for path in args.dirs])
+
+
+class Mount(Command):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser("mount", description="Mount index as read-only FUSE filesystem, files are fetched on demand")
+        arg.add_argument("mountpoint", help="Directory to mount index to")
+        arg.add_argument("--cache-dir", help="Directory for cache of fetched blocks", default=os.path.join(Path.home(), ".telefs_cache"))
+        arg.add_argument("--cache-size", help="Max size of blocks cache in MiB", type=int, default=1024)
+        arg.add_argument("--readahead", help="Blocks of 1 MiB to fetch ahead of sequential reads", type=int, default=4)
+        return arg
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        from . import mount
+        fs = await open_fs(client, fs_config)
+        await mount.mount(
+            fs,
+            os.path.abspath(args.mountpoint),
+            fs_config.index_name,
+            args.cache_dir,
+            args.cache_size * 1024 * 1024,
+            args.readahead,
+        )
+
+
+class Snapshot(OfflineCommand):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser("snapshot", description="Point-in-time copies of index sharing uploaded files with it")
+        actions = arg.add_subparsers(dest="action", required=True)
+        create = actions.add_parser("create", description="Save current index as snapshot")
+        create.add_argument("name", help="Name of snapshot")
+        listing = actions.add_parser("list", description="List snapshots of index")
+        cls.add_offline_flag(listing)
+        restore = actions.add_parser(
+            "restore",
+            description="Make index and local files same as in snapshot, only files with other hash are downloaded. "
+            "Files missing in snapshot are removed from index, but kept locally"
+        )
+        restore.add_argument("name", help="Name of snapshot")
+        diff = actions.add_parser("diff", description="Show files changed since snapshot")
+        diff.add_argument("name", help="Name of snapshot")
+        diff.add_argument("other", help="Compare with this snapshot instead of current index", nargs="?")
+        delete = actions.add_parser("delete", description="Delete snapshot and files only it refers to")
+        delete.add_argument("name", help="Name of snapshot")
+        return arg
+    
+    @classmethod
+    def offline(cls, args: argparse.Namespace) -> bool:
+        return args.action == "list" and args.offline
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client | None, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        fs = await open_fs(client, fs_config, offline=cls.offline(args))
+        
+        match args.action:
+            case "create":
+                info = await fs.create_snapshot(args.name)
+                print(f"Snapshot `{info.name}` of {info.files_count} files created")
+            case "list":
+                for info in sorted(fs.snapshots.values(), key=lambda info: info.created):
+                    created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info.created))
+                    print(f"{info.name}  {created}  {info.files_count} files")
+            case "delete":
+                await fs.delete_snapshot(args.name)
+            case "diff":
+                old = (await fs.load_snapshot(args.name)).files
+                new = (await fs.load_snapshot(args.other)).files if args.other else {
+                    path: fs.get_file_from_local_index(path) for path in fs.files
+                }
+                for path in sorted(old.keys() | new.keys()):
+                    if path not in new:
+                        print(f"-   {path}")
+                    elif path not in old:
+                        print(f"+   {path}")
+                    elif old[path].filehash != new[path].filehash:
+                        print(f"M   {path}")
+            case "restore":
+                await cls.restore(fs, fs_config, await fs.load_snapshot(args.name), args)
+    
+    @classmethod
+    async def restore(cls, fs: telegram.TelegramFileSystem, fs_config: config.FsConfig, snapshot: telegram.FileSystemIndex, args: argparse.Namespace):
+        changed = []
+        for path, f in snapshot.files.items():
+            current_path = os.path.join(fs_config.dir_path, path)
+            if not os.path.exists(current_path) or utils.hash_file(current_path) != f.filehash:
+                changed.append(path)
+        removed = set(fs.files) - snapshot.files.keys()
+        
+        pb = ProgressBar(name="Restoring", mode=args.progress)
+        async with pb, fs.operation() as op:
+            for path in removed:
+                op.delete(File(path, os.path.join(fs_config.dir_path, path), pb))
+            for f in snapshot.files.values():
+                await fs.restore_file(f, with_save=False)
+            for path in changed:
+                op.get(File(path, os.path.join(fs_config.dir_path, path), pb))
+        
+        for path in sorted(removed):
+            print(f"Not in snapshot, kept locally: {path}")
+
+
+class Limit(Command):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser(
+            "limit",
+            description="Show or change transfer rate limits, like 512K or 2M bytes per second, 0 is unlimited. "
+            "Running daemon reloads them at once, wath and mount reload them on SIGHUP"
+        )
+        arg.add_argument("--class", dest="traffic_class", help="Traffic class to limit", choices=shaping.CLASSES, default="total")
+        arg.add_argument("--upload", help="Upload rate limit")
+        arg.add_argument("--download", help="Download rate limit")
+        arg.add_argument("--from", dest="time_from", help="Start of daily schedule rule, HH:MM")
+        arg.add_argument("--to", dest="time_to", help="End of daily schedule rule, HH:MM")
+        arg.add_argument("--reset", help="Remove all limits and schedule rules", action="store_true")
+        return arg
+    
+    @classmethod
+    def needs_client(cls, args: argparse.Namespace, fs_config: config.FsConfig | None) -> bool:
+        return False
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client | None, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        shaper = shaping.shaper()
+        if (args.time_from is None) != (args.time_to is None):
+            raise exceptions.CommandValidationError("Both --from and --to must be specified")
+        new_limits = {
+            direction: value for direction, value in (("upload", args.upload), ("download", args.download))
+            if value is not None
+        }
+        for value in new_limits.values():
+            try:
+                shaping.parse_rate(value)
+            except ValueError:
+                raise exceptions.CommandValidationError(f"Wrong rate {value}")
+        if args.time_from is not None:
+            if not new_limits:
+                raise exceptions.CommandValidationError("Schedule rule needs --upload or --download limit")
+            for value in (args.time_from, args.time_to):
+                try:
+                    shaping.parse_time(value)
+                except ValueError as e:
+                    raise exceptions.CommandValidationError(str(e))
+        
+        if args.reset or new_limits:
+            if args.reset:
+                shaper.config = {}
+            if args.time_from is not None:
+                rule = {"from": args.time_from, "to": args.time_to, "limits": {args.traffic_class: new_limits}}
+                shaper.config.setdefault("schedule", []).append(rule)
+            elif new_limits:
+                shaper.config.setdefault("limits", {}).setdefault(args.traffic_class, {}).update(new_limits)
+            shaper.save()
+            from . import daemon
+            try:
+                await daemon.request({"command": "reload"})
+            except exceptions.DaemonNotRunning:
+                pass
+        
+        for traffic_class, limits in shaper.limits().items():
+            rates = ", ".join(
+                f"{direction} {utils.format_size(rate) + '/s' if rate else 'unlimited'}"
+                for direction, rate in limits.items()
+            )
+            print(f"{traffic_class}: {rates}")
+        for rule in shaper.config.get("schedule", []):
+            print(f"{rule['from']}-{rule['to']}: {json.dumps(rule['limits'])}")
+
+
+class Flush(Command):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser(
+            "flush",
+            description="Upload files waiting in local tier of tiered backend to telegram. "
+            "Running daemon and wath do it in background"
+        )
+        return arg
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        fs = await open_fs(client, fs_config)
+        print(f"{await fs.flush()} files uploaded")
+
+
+class Put(Command):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser(
+            "put",
+            description="Upload stdin to index as file without temporary copies, e.g. `pg_dump db | telefs put db.sql`"
+        )
+        arg.add_argument("path", help="Path of file in index, relative to current directory")
+        return arg
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        path = fs_config.get_path(os.path.abspath(args.path))
+        fs = await open_fs(client, fs_config, paths=[path])
+        
+        async def read(size: int) -> bytes:
+            return await asyncio.to_thread(sys.stdin.buffer.read, size)
+        
+        pb = ProgressBar(mode=args.progress)
+        async with pb:
+            await fs.put_stream(abstract.StreamFile(path, read, lambda curr, total: pb.print(path, curr, total)))
+
+
+class Cat(Command):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser("cat", description="Write files of index to stdout without temporary copies, e.g. `telefs cat x.tar | tar x`")
+        arg.add_argument("paths", help="Paths of files in index, relative to current directory", nargs="+")
+        return arg
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        paths = remote_paths(args.paths, fs_config)
+        fs = await open_fs(client, fs_config, paths=paths)
+        files = []
+        for path in paths:
+            f = fs.get_file_from_local_index(path)
+            if f is None:
+                raise exceptions.FileNotFound(f"No file {path} in index")
+            files.append(f)
+        
+        def write_out(data: bytes):
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        
+        async def write(data: bytes):
+            await asyncio.to_thread(write_out, data)
+        
+        # stdout is taken by data, so progress goes to stderr
+        pb = ProgressBar(name="Downloading", mode=args.progress, output=sys.stderr)
+        async with pb:
+            for f in files:
+                await fs.cat_file(f, write, lambda curr, total, path=f.path: pb.print(path, curr, total))
+
+
+class Rebalance(Command):
+    @classmethod
+    def edit_argparser(cls, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        arg = parser.add_parser(
+            "rebalance",
+            description="Change chats files are striped across and move files to chats they are placed to now. "
+            "Messages are copied by telegram, so files are not reuploaded"
+        )
+        arg.add_argument("--add", help="Chat to add, may be repeated", action="append", default=[])
+        arg.add_argument("--remove", help="Chat to remove, may be repeated", action="append", default=[])
+        return arg
+    
+    @classmethod
+    async def run(cls, client: pyrogram.Client, args: argparse.Namespace, app_config: config.AppConfig, fs_config: config.FsConfig | None):
+        if fs_config is None:
+            raise exceptions.WrongIndexException("Index not found")
+        if fs_config.backend == "local":
+            raise exceptions.CommandValidationError("Local backend stores files in one directory")
+        if args.add or args.remove:
+            # without storage chats all files are in chat of index, so it stays one of them
+            chats = list(fs_config.storage_chats or [fs_config.chat_id])
+            chats.extend(chat for chat in args.add if chat not in chats)
+            chats = [chat for chat in chats if chat not in args.remove]
+            if not chats:
+                raise exceptions.CommandValidationError("At least one storage chat is required")
+            fs_config.storage_chats = [] if chats == [fs_config.chat_id] else chats
+            # config is written first, so interrupted rebalance is continued by the next run
+            with open(os.path.join(fs_config.dir_path, config.FS_FILE_NAME), "w") as f:
+                json.dump(fs_config.dict(), f)
+        fs = await open_fs(client, fs_config)
+        misplaced = fs.misplaced()
+        async with fs.operation(traffic_class="background") as op:
+            for f in misplaced:
+                op.move(f)
+        print(f"{len(misplaced)} files moved")
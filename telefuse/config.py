@@ -1,10 +1,11 @@
 import pydantic
-from fs.osfs import OSFS
 import os
 import json
 
 
 FS_FILE_NAME = ".telefs"
+# `local` keeps files in `storage_path` only, `tiered` writes them there and drains to telegram
+BACKENDS = ("telegram", "local", "tiered")
 
 
 class FsNotFoundException(Exception):
@@ -21,21 +22,26 @@ class FsConfig(pydantic.BaseModel):
     session: str
     index_name: str
     dir_path: str
+    backend: str = "telegram"
+    storage_path: str | None = None
+    # chats files are striped across, chat of index is used when empty
+    storage_chats: list[str] = []
     
     @classmethod
     def find(cls, curr_path: str) -> "FsConfig":
-        with OSFS("/") as fs:
-            while curr_path:
-                for file in fs.listdir(curr_path):
-                    if file == FS_FILE_NAME:
-                        try:
-                            with fs.open(os.path.join(curr_path, FS_FILE_NAME), "r") as f:
-                                return cls(**json.load(f))
-                        except Exception:
-                            pass
-                if curr_path == "/":
-                    raise FsNotFoundException
-                curr_path = os.path.abspath(os.path.join(curr_path, os.path.pardir))
+        curr_path = os.path.abspath(curr_path)
+        while True:
+            config_path = os.path.join(curr_path, FS_FILE_NAME)
+            if os.path.isfile(config_path):
+                try:
+                    with open(config_path, "r") as f:
+                        return cls(**json.load(f))
+                except Exception:
+                    pass
+            parent = os.path.dirname(curr_path)
+            if parent == curr_path:
+                raise FsNotFoundException
+            curr_path = parent
     
     def get_path(self, path: str) -> str:
         return os.path.relpath(path, start=self.dir_path)
@@ -0,0 +1,216 @@
+from __future__ import annotations
+import asyncio
+import json
+import os
+import signal
+import typing
+from pathlib import Path
+from . import commands
+from . import config
+from . import exceptions
+from . import ignore
+from . import shaping
+from . import telegram
+from .wather import Wather
+
+if typing.TYPE_CHECKING:
+    import pyrogram
+
+
+SOCKET_PATH = os.path.join(Path.home(), ".telefs_daemon.sock")
+
+
+async def request(payload: dict[str, typing.Any], socket_path: str = SOCKET_PATH) -> typing.Any:
+    try:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        raise exceptions.DaemonNotRunning(f"No daemon listening on {socket_path}")
+    try:
+        writer.write((json.dumps(payload) + "\n").encode())
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    if not line:
+        raise exceptions.DaemonError("Daemon closed connection")
+    response = json.loads(line)
+    if not response["ok"]:
+        raise exceptions.DaemonError(response["error"])
+    return response["result"]
+
+
+class Workspace:
+    """Warm fs of one working directory: index in memory, watcher and batches of client requests"""
+
+    def __init__(self, client: pyrogram.Client | None, fs_config: config.FsConfig, app_config: config.AppConfig, window: float) -> None:
+        self.client = client
+        self.fs_config = fs_config
+        self.app_config = app_config
+        self.window = window
+        self.progress_bar = commands.ProgressBar(mode="none")
+        self.matcher = ignore.IgnoreMatcher.load(fs_config.dir_path)
+        self.fs: telegram.TelegramFileSystem | None = None
+        self.wather: Wather | None = None
+        self._wather_task: asyncio.Task | None = None
+        self._pending: list[tuple[typing.Type[commands.FileCommand], list[str], asyncio.Future]] = []
+        self._flush_task: asyncio.Task | None = None
+
+    def file_factory(self, path: str) -> commands.File:
+        return commands.File(self.fs_config.get_path(path), path, self.progress_bar)
+
+    async def start(self):
+        self.fs = await commands.open_fs(self.client, self.fs_config)
+        await self.fs.start()
+        self.wather = Wather(self.fs, self.file_factory, self.matcher)
+        self._wather_task = asyncio.create_task(self.wather.start_and_wait(self.fs_config.dir_path, self.fs_config))
+
+    async def stop(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        if self.wather is not None:
+            await self.wather.stop()
+        if self.fs is not None:
+            await self.fs.stop()
+
+    async def submit(self, command: typing.Type[commands.FileCommand], paths: list[str]) -> int:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((command, paths, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self):
+        await asyncio.sleep(self.window)
+        pending, self._pending, self._flush_task = self._pending, [], None
+        # watcher and moves reported by background drain change fs under the same lock,
+        # so their files are not mixed and refresh does not drop unsaved changes
+        async with self.fs.lock:
+            try:
+                # commands run without daemon save index too, so it is reloaded before it is changed here
+                await self.fs.refresh()
+            except Exception as e:
+                for _, _, future in pending:
+                    future.set_exception(e)
+                return
+            # invalid request fails alone and does not join batch
+            batch: list[tuple[typing.Type[commands.FileCommand], set[str], asyncio.Future]] = []
+            for command, paths, future in pending:
+                try:
+                    batch.append((command, await command.expand_files(self.fs, self.fs_config, paths, self.matcher), future))
+                except Exception as e:
+                    future.set_exception(e)
+            errors: dict[str, Exception] = {}
+            try:
+                async with self.fs.operation() as op:
+                    for command, files, _ in batch:
+                        for file_path in files:
+                            await command.exec(self.client, file_path, self.app_config, self.fs_config, op, self.progress_bar)
+            except exceptions.OperationError as e:
+                errors = e.errors
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+        for _, files, future in batch:
+            failed = [errors[path] for path in map(self.fs_config.get_path, files) if path in errors]
+            if failed:
+                future.set_exception(failed[0])
+            else:
+                future.set_result(len(files))
+
+class Server:
+    """
+    Daemon serving JSON lines requests on unix socket.
+
+    One telegram client is kept per session file and one `Workspace` per working directory,
+    both are created on the first request for them.
+    """
+
+    def __init__(self, app_config: config.AppConfig, socket_path: str = SOCKET_PATH, window: float = 0.1) -> None:
+        self.app_config = app_config
+        self.socket_path = socket_path
+        self.window = window
+        self.clients: dict[str, pyrogram.Client] = {}
+        self.workspaces: dict[str, Workspace] = {}
+        self._lock = asyncio.Lock()
+        self._stop_event = asyncio.Event()
+
+    async def workspace(self, dir_path: str) -> Workspace:
+        try:
+            fs_config = config.FsConfig.find(dir_path)
+        except config.FsNotFoundException:
+            raise exceptions.WrongIndexException(f"Index not found for {dir_path}")
+        async with self._lock:
+            workspace = self.workspaces.get(fs_config.dir_path)
+            if workspace is not None:
+                return workspace
+            client = self.clients.get(fs_config.session)
+            if client is None and fs_config.backend != "local":
+                from .main import start_telegram_client
+                client = start_telegram_client(self.app_config, fs_config.session)
+                await client.start()
+                self.clients[fs_config.session] = client
+            workspace = Workspace(client, fs_config, self.app_config, self.window)
+            await workspace.start()
+            self.workspaces[fs_config.dir_path] = workspace
+            return workspace
+
+    async def dispatch(self, payload: dict[str, typing.Any]) -> typing.Any:
+        match payload.get("command"):
+            case "ping":
+                return list(self.workspaces)
+            case "stop":
+                self._stop_event.set()
+                return None
+            case "reload":
+                shaping.shaper().reload()
+                return None
+            case name if name in commands.FILE_COMMANDS:
+                workspace = await self.workspace(payload["dir_path"])
+                return await workspace.submit(commands.FILE_COMMANDS[name], payload["files"])
+            case name:
+                raise exceptions.CommandValidationError(f"Unknown daemon command {name}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                try:
+                    response = {"ok": True, "result": await self.dispatch(json.loads(line))}
+                except Exception as e:
+                    response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+                if self._stop_event.is_set():
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, dirs: typing.Iterable[str] = ()):
+        try:
+            await request({"command": "ping"}, self.socket_path)
+        except exceptions.DaemonNotRunning:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        else:
+            raise exceptions.CommandValidationError(f"Daemon is already running on {self.socket_path}")
+
+        for dir_path in dirs:
+            await self.workspace(dir_path)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop_event.set)
+        loop.add_signal_handler(signal.SIGHUP, shaping.shaper().reload)
+
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        try:
+            async with server:
+                await self._stop_event.wait()
+        finally:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            for workspace in self.workspaces.values():
+                await workspace.stop()
+            for client in self.clients.values():
+                await client.stop()
@@ -11,4 +11,19 @@ class FileNotFound(Exception):
 
 
 class CommandValidationError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class DaemonNotRunning(Exception):
+    pass
+
+
+class DaemonError(Exception):
+    pass
+
+
+class OperationError(Exception):
+    """Some files of operation failed, the others are saved to index"""
+    def __init__(self, errors: dict[str, Exception]) -> None:
+        super().__init__("; ".join(f"{path}: {type(e).__name__}: {e}" for path, e in errors.items()))
+        self.errors = errors
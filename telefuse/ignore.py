@@ -0,0 +1,163 @@
+import os
+import re
+import typing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+IGNORE_FILE_NAME = ".telefsignore"
+DEFAULT_PATTERNS = ["/.telefs", "/.telefs_index"]
+
+
+def translate(pattern: str) -> str:
+    """Translates gitignore glob (without anchoring and negation) to regex"""
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == n:
+            res.append("/.*")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            res.append(".*")
+            i += 2
+            continue
+        c = pattern[i]
+        i += 1
+        match c:
+            case "*":
+                res.append("[^/]*")
+            case "?":
+                res.append("[^/]")
+            case "\\" if i < n:
+                res.append(re.escape(pattern[i]))
+                i += 1
+            case "[":
+                end = pattern.find("]", i + 1)
+                if end == -1:
+                    res.append(re.escape(c))
+                    continue
+                chars = pattern[i:end].replace("\\", "\\\\")
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                res.append(f"[{chars}]")
+                i = end + 1
+            case _:
+                res.append(re.escape(c))
+    return "".join(res)
+
+
+class IgnoreMatcher:
+    """
+    Compiled gitignore-style rules of `.telefsignore` in root of fs.
+
+    Consecutive rules with the same sign are merged into one regex, groups are
+    checked from the last one, so the last matching rule wins as in git.
+    """
+
+    def __init__(self, patterns: typing.Iterable[str]) -> None:
+        groups: list[tuple[bool, list[str], list[str]]] = []
+        for line in patterns:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if not line.endswith("\\ "):
+                line = line.rstrip()
+            negate = line.startswith("!")
+            if negate or line.startswith("\\!") or line.startswith("\\#"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            if "/" in line:
+                regex = "^" + translate(line.lstrip("/")) + "$"
+            else:
+                regex = "^(?:.*/)?" + translate(line) + "$"
+            if not groups or groups[-1][0] != negate:
+                groups.append((negate, [], []))
+            groups[-1][2 if dir_only else 1].append(regex)
+        self._groups = [
+            (negate, self._compile(any_rules), self._compile(dir_rules))
+            for negate, any_rules, dir_rules in reversed(groups)
+        ]
+
+    @staticmethod
+    def _compile(rules: list[str]) -> re.Pattern | None:
+        return re.compile("|".join(rules)) if rules else None
+
+    @classmethod
+    def load(cls, dir_path: str) -> "IgnoreMatcher":
+        patterns = list(DEFAULT_PATTERNS)
+        try:
+            with open(os.path.join(dir_path, IGNORE_FILE_NAME), "r") as f:
+                patterns.extend(f.readlines())
+        except FileNotFoundError:
+            pass
+        return cls(patterns)
+
+    def match(self, path: str, is_dir: bool) -> bool:
+        """Checks only path itself, parents must be checked by caller"""
+        for negate, any_rules, dir_rules in self._groups:
+            if any_rules is not None and any_rules.match(path) or is_dir and dir_rules is not None and dir_rules.match(path):
+                return not negate
+        return False
+
+    def is_ignored(self, path: str, is_dir: bool = False) -> bool:
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            if self.match("/".join(parts[:i]), True):
+                return True
+        return self.match(path, is_dir)
+
+
+def _scandir(path: str) -> tuple[list[str], list[str]]:
+    dirs, files = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return dirs, files
+
+
+def scan(root: str, base: str, matcher: IgnoreMatcher, workers: int = 8) -> tuple[list[str], list[str]]:
+    """
+    Lists not ignored files and directories under `root` with parallel os.scandir.
+
+    Paths are matched relative to `base`, ignored directories are not entered at all.
+    """
+    root = os.path.abspath(root)
+    root_rel = os.path.relpath(root, base).replace(os.sep, "/")
+    if root_rel == ".":
+        root_rel = ""
+    elif matcher.is_ignored(root_rel, is_dir=True):
+        return [], []
+    files: list[str] = []
+    dirs: list[str] = [root]
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(_scandir, root): (root, root_rel)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, rel = pending.pop(future)
+                subdirs, subfiles = future.result()
+                prefix = rel + "/" if rel else ""
+                for name in subdirs:
+                    if matcher.match(prefix + name, True):
+                        continue
+                    subdir = os.path.join(path, name)
+                    dirs.append(subdir)
+                    pending[pool.submit(_scandir, subdir)] = (subdir, prefix + name)
+                files.extend(
+                    os.path.join(path, name) for name in subfiles
+                    if not matcher.match(prefix + name, False)
+                )
+    return files, dirs
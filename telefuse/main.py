@@ -1,13 +1,18 @@
+from __future__ import annotations
 import asyncio
 from . import config
-import pyrogram
 import os
 from pathlib import Path
 import argparse
+import typing
 from . import commands
 
+if typing.TYPE_CHECKING:
+    import pyrogram
+
 
 def start_telegram_client(app_config: config.AppConfig, session: str) -> pyrogram.Client:
+    import pyrogram
     return pyrogram.Client(
         session,
         api_id=app_config.api_id,
@@ -16,23 +21,33 @@ def start_telegram_client(app_config: config.AppConfig, session: str) -> pyrogra
 
 
 def main():
+    # pyrogram is imported only by commands which start client, startup of local commands, e.g.
+    # `status --offline`, is bound by imports of asyncio and pydantic, which cached index needs
     try:
         fs_config = config.FsConfig.find(os.path.abspath(os.getcwd()))
     except config.FsNotFoundException:
         fs_config = None
     
     args = argparse.ArgumentParser()
+    args.add_argument(
+        "--progress",
+        help="Progress output: terminal bar, JSON lines or nothing. Auto uses bar only for tty",
+        choices=["auto", "bar", "json", "none"],
+        default="auto",
+    )
+    args.add_argument("--no-daemon", help="Do not send commands to running telefs daemon", action="store_true")
     app_config = config.AppConfig()
     session = os.path.join(Path.home(), ".telefs_session") if not fs_config else fs_config.session
-    client = start_telegram_client(app_config, session)
     
-    commands.init_commands(client, args.add_subparsers(), app_config, fs_config)
+    commands.init_commands(
+        lambda: start_telegram_client(app_config, session),
+        args.add_subparsers(), app_config, fs_config
+    )
     
     args = args.parse_args()
-    asyncio.set_event_loop(client.loop)
     
     try:
-        client.run(args.func(args))
+        asyncio.run(args.func(args))
     except AttributeError as e:
         print("Wrong command. Run with --help to see help")
         print(e)
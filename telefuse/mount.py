@@ -0,0 +1,248 @@
+import asyncio
+import collections
+import errno
+import functools
+import itertools
+import os
+import signal
+import stat
+import time
+from . import exceptions
+from . import shaping
+from . import telegram
+from . import tree
+
+
+# largest chunk of upload.GetFile, chunk offsets must be aligned to it
+BLOCK_SIZE = 1024 * 1024
+
+
+class BlockCache:
+    """
+    Bounded on-disk LRU cache of file blocks.
+
+    Blocks are keyed by file hash, so files updated in place in telegram never hit stale blocks.
+    """
+
+    def __init__(self, path: str, max_size: int) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self._blocks: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self._size = 0
+        with os.scandir(path) as it:
+            entries = sorted((entry for entry in it if entry.is_file() and not entry.name.startswith(".")), key=lambda entry: entry.stat().st_atime)
+        for entry in entries:
+            self._blocks[entry.name] = entry.stat().st_size
+            self._size += entry.stat().st_size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size and self._blocks:
+            key, size = self._blocks.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.path, key))
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._blocks
+
+    def get(self, key: str) -> bytes | None:
+        if key not in self._blocks:
+            return None
+        try:
+            with open(os.path.join(self.path, key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._size -= self._blocks.pop(key)
+            return None
+        self._blocks.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if key in self._blocks:
+            return
+        tmp_path = os.path.join(self.path, f".{key}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.path, key))
+        self._blocks[key] = len(data)
+        self._size += len(data)
+        self._evict()
+
+
+class Reader:
+    """Reads byte ranges of remote files block by block, with readahead for sequential reads"""
+
+    def __init__(self, fs: telegram.TelegramFileSystem, cache: BlockCache, readahead: int = 4) -> None:
+        self._fs = fs
+        self._cache = cache
+        self._readahead = readahead
+        self._sizes: dict[str, int] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._tasks: set[asyncio.Future] = set()
+
+    async def size(self, f: telegram.TelegramFile) -> int:
+        if f.key not in self._sizes:
+            self._sizes[f.key] = await self._fs.file_size(f)
+        return self._sizes[f.key]
+
+    async def _fetch(self, f: telegram.TelegramFile, index: int, key: str) -> bytes:
+        data = await self._fs.read_range(f, index * BLOCK_SIZE, BLOCK_SIZE)
+        self._cache.put(key, data)
+        return data
+
+    async def block(self, f: telegram.TelegramFile, index: int) -> bytes:
+        key = f"{f.filehash}_{index}"
+        data = self._cache.get(key)
+        if data is not None:
+            return data
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.ensure_future(self._fetch(f, index, key))
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _prefetch(self, f: telegram.TelegramFile, first: int, blocks_count: int):
+        for index in range(first, min(first + self._readahead, blocks_count)):
+            key = f"{f.filehash}_{index}"
+            if key in self._inflight or key in self._cache:
+                continue
+            task = asyncio.ensure_future(self.block(f, index))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            # readahead errors are reported by the read that needs the block
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def read(self, f: telegram.TelegramFile, offset: int, size: int, sequential: bool = False) -> bytes:
+        total = await self.size(f)
+        end = min(offset + size, total)
+        if offset >= end:
+            return b""
+        first, last = offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE
+        if sequential:
+            self._prefetch(f, last + 1, -(-total // BLOCK_SIZE))
+        blocks = await asyncio.gather(*(self.block(f, index) for index in range(first, last + 1)))
+        start = first * BLOCK_SIZE
+        return b"".join(blocks)[offset - start:end - start]
+
+
+class Operations:
+    """
+    Read-only fusepy operations over index tree.
+
+    Called from fuse threads, all backend calls are run in the event loop of the command.
+    """
+
+    def __init__(self, fs: telegram.TelegramFileSystem, reader: Reader, loop: asyncio.AbstractEventLoop) -> None:
+        self._fs = fs
+        self._reader = reader
+        self._loop = loop
+        self._handles: dict[int, list] = {}
+        self._fh = itertools.count(1)
+        self._stat = dict(st_uid=os.getuid(), st_gid=os.getgid(), st_atime=time.time(), st_mtime=time.time(), st_ctime=time.time())
+
+    def __call__(self, op: str, *args):
+        method = getattr(self, op, None)
+        if method is None:
+            raise OSError(errno.ENOSYS, op)
+        return method(*args)
+
+    # fusepy does not catch errors of init and destroy, so they must exist,
+    # the other no-ops return success like fuse.Operations does
+    def init(self, path: str) -> None:
+        pass
+
+    def destroy(self, path: str) -> None:
+        pass
+
+    def access(self, path: str, amode: int) -> int:
+        return 0
+
+    def opendir(self, path: str) -> int:
+        return 0
+
+    def releasedir(self, path: str, fh: int) -> int:
+        return 0
+
+    def flush(self, path: str, fh: int) -> int:
+        return 0
+
+    def _run(self, coro):
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+        except OSError:
+            raise
+        except exceptions.FileNotFound as e:
+            raise OSError(errno.ENOENT, str(e))
+        except Exception as e:
+            raise OSError(errno.EIO, str(e))
+
+    def _node(self, path: str) -> tree.DirNode | telegram.TelegramFile:
+        node = self._fs.tree.find(path)
+        if node is None:
+            raise OSError(errno.ENOENT, path)
+        return node
+
+    def getattr(self, path: str, fh: int | None = None) -> dict:
+        node = self._node(path)
+        if isinstance(node, tree.DirNode):
+            return self._stat | dict(st_mode=stat.S_IFDIR | 0o555, st_nlink=2 + len(node.dirs), st_size=0)
+        return self._stat | dict(st_mode=stat.S_IFREG | 0o444, st_nlink=1, st_size=self._run(self._reader.size(node)))
+
+    def readdir(self, path: str, fh: int) -> list[str]:
+        node = self._node(path)
+        if not isinstance(node, tree.DirNode):
+            raise OSError(errno.ENOTDIR, path)
+        return [".", "..", *node.dirs, *node.files]
+
+    def open(self, path: str, flags: int) -> int:
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise OSError(errno.EROFS, path)
+        node = self._node(path)
+        if isinstance(node, tree.DirNode):
+            raise OSError(errno.EISDIR, path)
+        fh = next(self._fh)
+        self._handles[fh] = [node, 0]
+        return fh
+
+    def read(self, path: str, size: int, offset: int, fh: int) -> bytes:
+        handle = self._handles[fh]
+        sequential = offset == handle[1]
+        handle[1] = offset + size
+        return self._run(self._reader.read(handle[0], offset, size, sequential))
+
+    def release(self, path: str, fh: int) -> int:
+        self._handles.pop(fh, None)
+        return 0
+
+    def statfs(self, path: str) -> dict:
+        root = self._fs.tree.root
+        return dict(
+            f_bsize=BLOCK_SIZE, f_frsize=BLOCK_SIZE, f_blocks=-(-root.size // BLOCK_SIZE),
+            f_bfree=0, f_bavail=0, f_files=root.count, f_ffree=0, f_namemax=255
+        )
+
+
+async def mount(fs: telegram.TelegramFileSystem, mountpoint: str, name: str, cache_dir: str, cache_size: int, readahead: int):
+    try:
+        import fuse
+    except (ImportError, OSError) as e:
+        raise exceptions.CommandValidationError(f"FUSE is not available: {e}. Install libfuse and fusepy")
+
+    loop = asyncio.get_running_loop()
+    operations = Operations(fs, Reader(fs, BlockCache(cache_dir, cache_size), readahead), loop)
+
+    async def unmount():
+        process = await asyncio.create_subprocess_exec("fusermount", "-u", mountpoint)
+        await process.wait()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: asyncio.create_task(unmount()))
+    loop.add_signal_handler(signal.SIGHUP, shaping.shaper().reload)
+
+    await loop.run_in_executor(None, functools.partial(
+        fuse.FUSE, operations, mountpoint, foreground=True, ro=True, nothreads=False, fsname=f"telefs:{name}"
+    ))
@@ -0,0 +1,192 @@
+import asyncio
+import datetime
+import json
+import os
+import re
+import sys
+import time
+import typing
+from pathlib import Path
+
+
+CONFIG_PATH = os.path.join(Path.home(), ".telefs_shaping.json")
+DIRECTIONS = ("upload", "download")
+# `total` limits all classes together
+CLASSES = ("interactive", "background", "total")
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(value: str | int | None) -> int | None:
+    """Parses bytes per second like `512K` or `2M`, no value or 0 means unlimited"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = value.strip().upper()
+        if value in ("UNLIMITED", "NONE"):
+            return None
+        multiplier = UNITS.get(value[-1], 1)
+        value = int(float(value.rstrip("KMGB")) * multiplier)
+    return value or None
+
+
+def parse_time(hhmm: str) -> int:
+    """Parses `HH:MM` of schedule rule to minutes since midnight"""
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})", hhmm.strip())
+    if match is None or int(match[1]) > 23 or int(match[2]) > 59:
+        raise ValueError(f"Wrong time {hhmm}, HH:MM is expected")
+    return int(match[1]) * 60 + int(match[2])
+
+
+def check_limits(limits: dict[str, dict[str, str | int | None]]):
+    for traffic_class in CLASSES:
+        for direction in DIRECTIONS:
+            if direction in limits.get(traffic_class, {}):
+                parse_rate(limits[traffic_class][direction])
+
+
+class TokenBucket:
+
+    def __init__(self, rate: int | None = None, burst: float = 1.0) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens: float = rate * burst if rate else 0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.rate * self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: int | None):
+        self._refill()
+        self.rate = rate
+        if rate:
+            self.tokens = min(self.tokens, rate * self.burst)
+
+    async def consume(self, amount: int):
+        if not self.rate or amount <= 0:
+            return
+        # lock keeps waiters in order, bytes already sent are taken as debt
+        async with self._lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens < 0 and self.rate:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Shaper:
+    """
+    Limits transfer bytes per traffic class and direction.
+
+    Limits are read from `~/.telefs_shaping.json`:
+        {
+            "limits": {"background": {"upload": "1M"}, "total": {"download": "10M"}},
+            "schedule": [{"from": "09:00", "to": "18:00", "limits": {"background": {"upload": "256K"}}}]
+        }
+    Schedule rules override base limits while local time is in their range.
+    """
+
+    def __init__(self, path: str = CONFIG_PATH) -> None:
+        self.path = path
+        self.config: dict[str, typing.Any] = {}
+        self.buckets = {
+            (traffic_class, direction): TokenBucket()
+            for traffic_class in CLASSES for direction in DIRECTIONS
+        }
+        self._minute: int | None = None
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(self.path, "r") as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        except ValueError as e:
+            self._report(f"Cannot read {self.path}: {e}, limits are not applied")
+            config = {}
+        self.config = self._checked(config)
+        self._apply()
+    
+    def _report(self, message: str):
+        # stdout may be taken by data, e.g. of `telefs cat`
+        print(message, file=sys.stderr)
+    
+    def _checked(self, config: typing.Any) -> dict[str, typing.Any]:
+        """Drops limits and schedule rules which can not be parsed, so wrong config does not break transfers"""
+        if not isinstance(config, dict):
+            self._report(f"Wrong shaping config {self.path}, limits are not applied")
+            return {}
+        checked: dict[str, typing.Any] = {}
+        try:
+            check_limits(config.get("limits", {}))
+            checked["limits"] = config.get("limits", {})
+        except (ValueError, TypeError, AttributeError) as e:
+            self._report(f"Wrong limits in {self.path}: {e}, they are ignored")
+        for rule in config.get("schedule", []):
+            try:
+                parse_time(rule["from"])
+                parse_time(rule["to"])
+                check_limits(rule.get("limits", {}))
+            except (ValueError, TypeError, AttributeError, KeyError) as e:
+                self._report(f"Wrong schedule rule {json.dumps(rule)} in {self.path}: {e}, it is ignored")
+                continue
+            checked.setdefault("schedule", []).append(rule)
+        return checked
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.config, f, indent=4)
+        self._apply()
+
+    def limits(self, now: datetime.datetime | None = None) -> dict[str, dict[str, int | None]]:
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        sources = [self.config.get("limits", {})]
+        for rule in self.config.get("schedule", []):
+            start, end = parse_time(rule["from"]), parse_time(rule["to"])
+            if start <= minute < end or start > end and (minute >= start or minute < end):
+                sources.append(rule.get("limits", {}))
+        limits: dict[str, dict[str, int | None]] = {traffic_class: {} for traffic_class in CLASSES}
+        for traffic_class in CLASSES:
+            for direction in DIRECTIONS:
+                for source in sources:
+                    if direction in source.get(traffic_class, {}):
+                        limits[traffic_class][direction] = parse_rate(source[traffic_class][direction])
+                limits[traffic_class].setdefault(direction, None)
+        return limits
+
+    def _apply(self):
+        self._minute = int(time.time() // 60)
+        limits = self.limits()
+        for (traffic_class, direction), bucket in self.buckets.items():
+            bucket.set_rate(limits[traffic_class][direction])
+
+    async def consume(self, traffic_class: str, direction: str, amount: int):
+        if int(time.time() // 60) != self._minute:
+            self._apply()
+        await self.buckets[(traffic_class, direction)].consume(amount)
+        await self.buckets[("total", direction)].consume(amount)
+
+    def progress(self, traffic_class: str, direction: str, callback: typing.Callable[[int, int], typing.Any]) -> typing.Callable[[int, int], typing.Awaitable]:
+        """Wraps pyrogram progress callback, pyrogram awaits it between chunks, so sleeping here slows transfer"""
+        last = 0
+
+        async def progress(curr: int, total: int):
+            nonlocal last
+            amount, last = curr - last, curr
+            await self.consume(traffic_class, direction, amount)
+            callback(curr, total)
+        return progress
+
+
+_shaper: Shaper | None = None
+
+
+def shaper() -> Shaper:
+    global _shaper
+    if _shaper is None:
+        _shaper = Shaper()
+    return _shaper
@@ -1,14 +1,24 @@
+from __future__ import annotations
 import typing
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr, root_validator
 from . import utils
 import json
-import pyrogram
 from .exceptions import WrongIndexException
 from . import abstract
+from . import shaping
+from .backends import StorageBackend, file_key, parse_file_key
+from .tree import IndexTree, split_path
 import os
 from . import exceptions
 import asyncio
+import hashlib
 import itertools
+import secrets
+import tempfile
+import time
+
+if typing.TYPE_CHECKING:
+    import pyrogram
 
 
 class TelegramFile(BaseModel):
@@ -16,33 +26,142 @@ class TelegramFile(BaseModel):
     path: str
     msg_id: int
     filehash: str
+    size: int = 0
+    # storage chat of message, None is chat of index
+    chat: str | None = None
+    
+    @property
+    def key(self) -> str:
+        return file_key(self.msg_id, self.chat)
     
     @classmethod
-    def from_abstract(cls, f: abstract.File, msg_id: int) -> "TelegramFile":
+    def from_abstract(cls, f: abstract.File, msg_id: int, chat: str | None = None) -> "TelegramFile":
         return cls(
             name = f.name,
             path = f.path,
             msg_id = msg_id,
-            filehash = f.get_hash()
+            filehash = f.get_hash(),
+            size = f.get_size(),
+            chat = chat
         )
     
 
-class FileSystemIndex(BaseModel):
+class SnapshotInfo(BaseModel):
+    name: str
+    message_id: int
+    created: float
+    files_count: int
+    # shard documents of snapshot, they are deleted with it
+    shard_ids: list[int] = []
+
+
+class ShardInfo(BaseModel):
+    message_id: int = 0
+    # random token of the last save, counters of two writers of the same version would be equal,
+    # integer versions of old indexes are taken as strings
+    version: str = ""
+    files_count: int = 0
+
+
+class IndexShard(BaseModel):
     files: dict[str, TelegramFile]
+    # keys of messages of shard paths kept by snapshots
+    retained: dict[str, list[str]] = {}
+
+
+def shard_key(path: str) -> str:
+    """Files are sharded by top-level directory, files of root are in shard `""`"""
+    parts = split_path(path)
+    return parts[0] if len(parts) > 1 else ""
+
+
+def shard_keys(paths: typing.Iterable[str] | None) -> set[str] | None:
+    """Shards which files may be under paths, None means all of them"""
+    if paths is None:
+        return None
+    keys = set()
+    for path in paths:
+        parts = split_path(path)
+        if not parts:
+            return None
+        keys.add(parts[0])
+        if len(parts) == 1:
+            keys.add("")
+    return keys
+
+
+class FileSystemIndex(BaseModel):
+    """
+    Uploaded index is small manifest, files are kept in shard documents by top-level directory.
+
+    Only shards of used paths are loaded and only changed ones are saved again. Local copy of index
+    keeps files of all loaded shards, they are not downloaded again while shard versions are the same.
+    Indexes of old versions keep files in manifest, they are resharded on the first save.
+    """
+    files: dict[str, TelegramFile] = {}
     index_name: str
     message_id: int = 0
+    snapshots: dict[str, SnapshotInfo] = {}
+    # keys of files kept by snapshots by shard of their path, they must not be deleted or edited in place,
+    # they are saved in shard documents
+    retained: dict[str, dict[str, list[str]]] = {}
+    # retained keys of old versions, which kept them in manifest, they are moved to shards on open
+    legacy_retained: dict[str, list[str]] = {}
+    shards: dict[str, ShardInfo] = {}
+    # versions of shards loaded to `files`, they are kept only in local copy
+    loaded: dict[str, str] = {}
+    _dirty: set[str] = PrivateAttr(default_factory=set)
+    # saves of the same index, e.g. of operation and of background drain of backend, go one by one,
+    # private attributes are shared by shallow copies of fs clones
+    _save_lock: asyncio.Lock = PrivateAttr(default_factory=asyncio.Lock)
+    # size and mtime of local copies written by this index, other processes may write them too
+    _written: dict[str, tuple[int, int]] = PrivateAttr(default_factory=dict)
+    
+    @root_validator(pre=True)
+    def _split_legacy_retained(cls, values: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        retained = values.get("retained") or {}
+        if any(isinstance(names, list) for names in retained.values()):
+            values["legacy_retained"] = values.pop("retained")
+        return values
     
     @classmethod
-    @utils.retry(3)
-    async def _get(cls, client: pyrogram.Client, chat_id: str | int, index_name: str, location: str) -> "FileSystemIndex":
-        res = client.search_messages(chat_id=chat_id, query=f"[{index_name}]", limit=1, filter="document")
+    async def _get(cls, backend: StorageBackend, index_name: str, location: str, paths: typing.Iterable[str] | None = None) -> "FileSystemIndex":
         try:
-            res = await res.__anext__()
-        except StopAsyncIteration:
-            raise WrongIndexException(f"Can not find index with name {index_name}")
-
-        await client.download_media(res, location)
-        
+            cached = cls.load(location)
+        except WrongIndexException:
+            cached = None
+        with tempfile.TemporaryDirectory() as tmp:
+            index = None
+            if cached is not None and cached.index_name == index_name and cached.message_id:
+                # manifest keeps its message, so search is needed only for new copies of index
+                try:
+                    await backend.load_document(cached.message_id, os.path.join(tmp, "index"))
+                    index = cls.load(os.path.join(tmp, "index"))
+                except WrongIndexException:
+                    index = None
+            if index is None or index.index_name != index_name or index.message_id != cached.message_id:
+                try:
+                    await backend.find_document(f"[{index_name}]", os.path.join(tmp, "index"))
+                except WrongIndexException:
+                    raise WrongIndexException(f"Can not find index with name {index_name}")
+                index = cls.load(os.path.join(tmp, "index"))
+        if cached is not None and cached.message_id != index.message_id:
+            cached = None
+        await index.load_shards(backend, shard_keys(paths), cached)
+        index.write(location)
+        return index
+    
+    @classmethod
+    async def _get_by_id(cls, backend: StorageBackend, message_id: int, location: str) -> "FileSystemIndex":
+        await backend.load_document(message_id, location)
+        index = cls.load(location)
+        await index.load_shards(backend)
+        return index
+    
+    @classmethod
+    def load(cls, location: str) -> "FileSystemIndex":
+        if not os.path.exists(location):
+            raise WrongIndexException(f"No local copy of index in {location}")
         with open(location, 'r') as f:
             msg = json.load(f)
         try:
@@ -50,38 +169,152 @@ class FileSystemIndex(BaseModel):
         except Exception:
             raise WrongIndexException("Index is corrupted")
     
-    @utils.retry(3)
-    async def save(self, client: pyrogram.Client, chat_id: str | int, location: str):
+    def _add_loaded(self, key: str, files: dict[str, TelegramFile], retained: dict[str, list[str]], new_files: list[TelegramFile]):
+        # files changed in memory before their shard is loaded are newer
+        for path, f in files.items():
+            if path not in self.files:
+                self.files[path] = f
+                new_files.append(f)
+        if retained:
+            self.retained[key] = retained | self.retained.get(key, {})
+        self.loaded[key] = self.shards[key].version
+    
+    async def load_shards(self, backend: StorageBackend, keys: set[str] | None = None, cached: "FileSystemIndex | None" = None) -> list[TelegramFile]:
+        """Loads files of shards, all up-to-date shards of cached copy are taken too. Returns new files"""
+        new_files: list[TelegramFile] = []
+        if cached is not None:
+            by_shard: dict[str, dict[str, TelegramFile]] = {}
+            for path, f in cached.files.items():
+                by_shard.setdefault(shard_key(path), {})[path] = f
+            for key, info in self.shards.items():
+                if key not in self.loaded and cached.loaded.get(key) == info.version:
+                    self._add_loaded(key, by_shard.get(key, {}), cached.retained.get(key, {}), new_files)
+        
+        async def load(key: str):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "shard")
+                await backend.load_document(self.shards[key].message_id, path)
+                with open(path, 'r') as f:
+                    shard = IndexShard(**json.load(f))
+            self._add_loaded(key, shard.files, shard.retained, new_files)
+        
+        keys = set(self.shards) if keys is None else keys & set(self.shards)
+        await asyncio.gather(*(load(key) for key in keys if key not in self.loaded))
+        return new_files
+    
+    def touch(self, path: str):
+        """Marks shard of path as changed"""
+        self.touch_shard(shard_key(path))
+    
+    def touch_shard(self, key: str):
+        self._dirty.add(key)
+    
+    def write(self, location: str):
         with open(location, 'w') as f:
             f.write(self.json())
-        if self.message_id == 0:
-            msg = await client.send_document(chat_id=chat_id, document=location, caption=f"[{self.index_name}]")
-            if msg is None:
-                raise exceptions.RetryableError("Cannot save index")
-            self.message_id = msg.message_id
-            with open(location, 'w') as f:
-                f.write(self.json())
-        await client.edit_message_media(chat_id=chat_id, message_id=self.message_id, media=pyrogram.types.InputMediaDocument(
-                    media=location,
-                    caption=f"[{self.index_name}]"
-                )
-            )
+        stat = os.stat(location)
+        self._written[location] = (stat.st_size, stat.st_mtime_ns)
+    
+    def changed_on_disk(self, location: str) -> bool:
+        """Local copy was saved by other process, e.g. by command run besides daemon"""
+        try:
+            stat = os.stat(location)
+        except FileNotFoundError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) != self._written.get(location)
+    
+    async def refresh(self, backend: StorageBackend, location: str) -> bool:
+        """Reloads index with the same shards loaded, if it was saved by other process. Returns whether it was"""
+        async with self._save_lock:
+            if not self.changed_on_disk(location):
+                return False
+            index = await FileSystemIndex._get(backend, self.index_name, location, [])
+            await index.load_shards(backend, set(self.loaded))
+            index.write(location)
+            # fields are updated in place, as they are shared with copies of fs clones
+            for name in ("files", "snapshots", "retained", "legacy_retained", "shards", "loaded"):
+                getattr(self, name).clear()
+                getattr(self, name).update(getattr(index, name))
+            self.message_id = index.message_id
+            self._written.update(index._written)
+            return True
+    
+    async def _save_shard(self, backend: StorageBackend, key: str, files: dict[str, TelegramFile]):
+        info = self.shards.setdefault(key, ShardInfo())
+        retained = self.retained.get(key, {})
+        if not files and not retained:
+            self.shards.pop(key)
+            self.loaded.pop(key, None)
+            await backend.delete_file(info.message_id)
+            return
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "shard")
+            with open(path, 'w') as f:
+                f.write(IndexShard(files=files, retained=retained).json())
+            info.message_id = await backend.save_document(path, f"[{self.index_name}#{key}]", info.message_id) or info.message_id
+        info.version = secrets.token_hex(8)
+        info.files_count = len(files)
+        self.loaded[key] = info.version
+    
+    async def save(self, backend: StorageBackend, location: str):
+        async with self._save_lock:
+            await self._save(backend, location)
+    
+    async def _save(self, backend: StorageBackend, location: str):
+        dirty = set(self._dirty)
+        self._dirty.clear()
+        if not self.shards and self.files:
+            dirty |= {shard_key(path) for path in self.files}
+        try:
+            # saving shard not loaded yet would drop its files
+            await self.load_shards(backend, dirty)
+            groups: dict[str, dict[str, TelegramFile]] = {key: {} for key in dirty}
+            for path, f in self.files.items():
+                files = groups.get(shard_key(path))
+                if files is not None:
+                    files[path] = f
+            await asyncio.gather(*(self._save_shard(backend, key, files) for key, files in groups.items()))
+        except Exception:
+            self._dirty |= dirty
+            raise
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = os.path.join(tmp, "index")
+            if self.message_id == 0:
+                # index refers to its own document, so it is saved twice
+                with open(manifest, 'w') as f:
+                    f.write(self.json(exclude={"files", "loaded", "retained"}))
+                self.message_id = await backend.save_document(manifest, f"[{self.index_name}]")
+            with open(manifest, 'w') as f:
+                f.write(self.json(exclude={"files", "loaded", "retained"}))
+            await backend.save_document(manifest, f"[{self.index_name}]", self.message_id)
+        self.write(location)
 
 
 class OperationCtx:
-    def __init__(self, fs: "TelegramFileSystem", max_inflight: int) -> None:
-        self._semaphore = asyncio.Semaphore(max_inflight)
+    def __init__(self, fs: "TelegramFileSystem", max_inflight: int, traffic_class: str = "interactive") -> None:
+        # transfers are limited per storage chat, so files of different chats go concurrently
+        self._max_inflight = max_inflight
+        self._semaphores: dict[str | None, asyncio.Semaphore] = {}
+        self._traffic_class = traffic_class
         self._files_to_get: list[abstract.File] = []
         self._files_to_add: list[abstract.File] = []
         self._files_to_delete: list[abstract.File] = []
+        self._files_to_move: list[TelegramFile] = []
         self._fs = fs
         
     async def __aenter__(self):
         self._files_to_get = []
         self._files_to_add = []
         self._files_to_delete = []
+        self._files_to_move = []
         return self
     
+    def _slot(self, chat: str | None) -> asyncio.Semaphore:
+        if chat not in self._semaphores:
+            self._semaphores[chat] = asyncio.Semaphore(self._max_inflight)
+        return self._semaphores[chat]
+    
     def add(self, f: abstract.File):
         if f.path in ('.telefs_index', '.telefs'):
             return
@@ -97,24 +330,37 @@ class OperationCtx:
             return
         self._files_to_delete.append(f)
     
+    def move(self, f: TelegramFile):
+        """Moves file to storage chat it is placed to now"""
+        self._files_to_move.append(f)
+    
     async def __upload(self, file: abstract.File):
-        async with self._semaphore:
-            await self._fs.init_file(file, with_save=False)
+        async with self._slot(self._fs.place(file.path)):
+            await self._fs.init_file(file, with_save=False, traffic_class=self._traffic_class)
     
     async def __get(self, file: abstract.File):
-        async with self._semaphore:
-            await self._fs.get_file(file)
+        # message lookups are batched, so they are made before taking transfer slot
+        await self._fs.prefetch_file(file)
+        f = self._fs.get_file_from_local_index(file.path)
+        async with self._slot(None if f is None else f.chat):
+            await self._fs.get_file(file, traffic_class=self._traffic_class)
+    
+    async def __move(self, f: TelegramFile):
+        async with self._slot(f.chat):
+            await self._fs.move_file(f, with_save=False)
 
     async def __delete(self, file: abstract.File):
-        async with self._semaphore:
-            await self._fs.remove_file(file, with_save=False)
+        # deletes are not transfers and are merged into batches by api
+        await self._fs.remove_file(file, with_save=False)
     
     async def save(self):
         add = {file.path: file for file in self._files_to_add}
         delete = {file.path: file for file in self._files_to_delete}
         get = {file.path: file for file in self._files_to_get}
         
-        if not add and not get and not delete:
+        move = {f.path: f for f in self._files_to_move}
+        
+        if not add and not get and not delete and not move:
             return
         
         for key in add:
@@ -122,20 +368,29 @@ class OperationCtx:
         for key in delete:
             add.pop(key, None)
             get.pop(key, None)
+        for key in (*add, *delete):
+            move.pop(key, None)
         
         files = set(self._fs.files)
         for key in delete.copy():
             if key not in files:
                 delete.pop(key)
         
+        paths = [*add, *get, *delete, *move]
         tasks = [self.__upload(file) for file in add.values()]
         tasks.extend(self.__get(file) for file in get.values())
         tasks.extend(self.__delete(file) for file in delete.values())
-        await asyncio.gather(*tasks)
+        tasks.extend(self.__move(f) for f in move.values())
+        # failed file does not stop the others, files done are saved to index anyway
+        results = await asyncio.gather(*tasks, return_exceptions=True)
         await self._fs.save()
         self._files_to_add = []
         self._files_to_delete = []
         self._files_to_get = []
+        self._files_to_move = []
+        errors = {path: res for path, res in zip(paths, results) if isinstance(res, Exception)}
+        if errors:
+            raise exceptions.OperationError(errors)
     
     async def __aexit__(self, exception_type, exception_value, exception_traceback):
         if exception_type is None:
@@ -143,67 +398,425 @@ class OperationCtx:
             self._files_to_get = []
             self._files_to_add = []
             self._files_to_delete = []
+            self._files_to_move = []
 
 
 class TelegramFileSystem:
     
-    def __init__(self, api: "TelegramApi", index: FileSystemIndex, chat_id: str | int, client: pyrogram.Client, location: str) -> None:
-        self._api = api
+    def __init__(self, backend: StorageBackend | None, index: FileSystemIndex, location: str) -> None:
+        self._backend = backend
         self._index = index
-        self._chat_id = chat_id
-        self._client = client
         self._location = location
+        self._tree: IndexTree | None = None
+        # changes of index by long living owners, e.g. daemon batches, watcher saves and moves
+        # reported by backend, go one by one, so refresh does not drop changes of other one
+        self.lock = asyncio.Lock()
     
     @property
     def files(self) -> typing.Iterable[str]:
         return iter(self._index.files)
     
+    @property
+    def tree(self) -> IndexTree:
+        if self._tree is None:
+            self._tree = IndexTree.from_files(self._index.files)
+        return self._tree
+    
+    def walk(self, path: str = "") -> typing.Iterable[TelegramFile]:
+        return self.tree.walk(path)
+    
     def get_file_from_local_index(self, file_path: str) -> TelegramFile | None:
         return self._index.files.get(file_path)
     
     @classmethod
-    async def with_telegram_api(cls, api: "TelegramApi", client: pyrogram.Client, chat_id: str | int, index_name: str, location: str) -> "TelegramFileSystem":
-        index = await FileSystemIndex._get(client=client, chat_id=chat_id, index_name=index_name, location=location)
-        return cls(api, index, chat_id, client, location)
-    
-    async def init_file(self, file: abstract.File, with_save: bool = True) -> None:
-        msg_id = None if not self._index.files.get(file.path) else self._index.files[file.path].msg_id
-        curr_msg_id = await self._api.upload_file(self._chat_id, file, msg_id=msg_id, progres=file.progress)
-        self._index.files[file.path] = TelegramFile.from_abstract(file, curr_msg_id)
+    async def with_backend(cls, backend: StorageBackend, index_name: str, location: str, paths: typing.Iterable[str] | None = None) -> "TelegramFileSystem":
+        """Opens index with files under `paths` loaded, all of them by default"""
+        index = await FileSystemIndex._get(backend, index_name, location, paths)
+        fs = cls(backend, index, location)
+        if index.legacy_retained:
+            await fs._migrate_retained()
+        return fs
+    
+    @classmethod
+    async def with_telegram_api(cls, api: "TelegramApi", client: pyrogram.Client, chat_id: str | int, index_name: str, location: str, paths: typing.Iterable[str] | None = None) -> "TelegramFileSystem":
+        return await cls.with_backend(TelegramBackend(api, client, chat_id), index_name, location, paths)
+    
+    @classmethod
+    def offline(cls, location: str) -> "TelegramFileSystem":
+        """Read-only fs over the locally cached copy of index, without storage backend"""
+        return cls(None, FileSystemIndex.load(location), location)
+    
+    async def _migrate_retained(self):
+        """Moves retained keys of manifest to shards, their paths are found in live index and in snapshots"""
+        await self.load()
+        paths = {f.key: f.path for f in self._index.files.values()}
+        for name in self._index.snapshots:
+            snapshot = await self.load_snapshot(name)
+            for f in snapshot.files.values():
+                paths.setdefault(f.key, f.path)
+        for key, names in self._index.legacy_retained.items():
+            if key in paths:
+                self._index.retained.setdefault(shard_key(paths[key]), {})[key] = names
+                self._index.touch(paths[key])
+        self._index.legacy_retained = {}
+        await self.save()
+    
+    async def load(self, paths: typing.Iterable[str] | None = None):
+        """Loads shards of index with files under `paths`, all of them by default"""
+        new_files = await self._index.load_shards(self._backend, shard_keys(paths))
+        if self._tree is not None:
+            for f in new_files:
+                self._tree.add(f)
+    
+    async def start(self):
+        await self._backend.start(self._on_moved)
+    
+    async def stop(self):
+        await self._backend.stop()
+    
+    async def flush(self) -> int:
+        """Waits until background work of backend, e.g. draining of local tier, is done"""
+        return await self._backend.flush(self._on_moved)
+    
+    async def refresh(self):
+        """Reloads index saved by other process, long living fs must do it before it is changed"""
+        if await self._index.refresh(self._backend, self._location) and self._tree is not None:
+            # tree is shared with clones too
+            self._tree.root = IndexTree.from_files(self._index.files).root
+    
+    async def _on_moved(self, moves: list[tuple[int, int, str, str | None]]):
+        async with self.lock:
+            await self.refresh()
+            for old_id, new_id, path, chat in moves:
+                f = self._index.files.get(path)
+                if f is not None and f.msg_id == old_id and f.chat == chat:
+                    f.msg_id = new_id
+                    self._index.touch(path)
+                retained = self._index.retained.get(shard_key(path), {})
+                if file_key(old_id, chat) in retained:
+                    retained[file_key(new_id, chat)] = retained.pop(file_key(old_id, chat))
+                    self._index.touch(path)
+            await self.save()
+    
+    def is_retained(self, f: TelegramFile) -> bool:
+        return bool(self._index.retained.get(shard_key(f.path), {}).get(f.key))
+    
+    def place(self, path: str) -> str | None:
+        """Storage chat for new version of file"""
+        return self._backend.place(path)
+    
+    def misplaced(self) -> list[TelegramFile]:
+        """Files not in chat they are placed to, e.g. after storage chats were changed"""
+        return [f for f in self._index.files.values() if f.msg_id != 0 and f.chat != self.place(f.path)]
+    
+    async def _release(self, old: TelegramFile | None, new: TelegramFile):
+        """Deletes message of old version of file, unless it is still used"""
+        if old is not None and old.key != new.key and not self.is_retained(old):
+            await self._backend.delete_file(old.msg_id, old.chat)
+    
+    async def init_file(self, file: abstract.File, with_save: bool = True, traffic_class: str = "interactive") -> None:
+        old = self._index.files.get(file.path)
+        chat = self.place(file.path)
+        msg_id = None
+        # snapshot may still refer to old content, and file may be placed to other chat now,
+        # then new version goes to new message
+        if old is not None and old.chat == chat and not self.is_retained(old):
+            msg_id = old.msg_id
+        curr_msg_id = await self._backend.upload_file(file, file_id=msg_id, progres=file.progress, traffic_class=traffic_class, volume=chat)
+        self._index.files[file.path] = TelegramFile.from_abstract(file, curr_msg_id, chat)
+        self._index.touch(file.path)
+        if self._tree is not None:
+            self._tree.add(self._index.files[file.path])
+        if msg_id is None:
+            # otherwise backend replaces old file itself, even if it gives new id, e.g. pending one of tiered backend
+            await self._release(old, self._index.files[file.path])
         if with_save:
-            await self._index.save(self._client, self._chat_id, self._location)
+            await self.save()
+    
+    async def move_file(self, f: TelegramFile, with_save: bool = True) -> None:
+        """Moves file to chat it is placed to without reupload"""
+        chat = self.place(f.path)
+        msg_id = await self._backend.copy_file(f.msg_id, f.chat, chat)
+        moved = f.copy(update={"msg_id": msg_id, "chat": chat})
+        self._index.files[f.path] = moved
+        self._index.touch(f.path)
+        if self._tree is not None:
+            self._tree.add(moved)
+        await self._release(f, moved)
+        if with_save:
+            await self.save()
     
-    async def get_file(self, file: abstract.File):
+    async def put_stream(self, file: abstract.StreamFile, with_save: bool = True, traffic_class: str = "interactive") -> None:
+        """Stores stream as file of index, stream always goes to new message, as its size is unknown before upload"""
+        node = self.tree.find(file.path)
+        if node is not None and not isinstance(node, TelegramFile):
+            raise exceptions.CommandValidationError(f"{file.path} is directory in index")
+        chat = self.place(file.path)
+        msg_id = await self._backend.upload_stream(file, traffic_class=traffic_class, volume=chat)
+        old = self._index.files.get(file.path)
+        self._index.files[file.path] = TelegramFile.from_abstract(file, msg_id, chat)
+        self._index.touch(file.path)
+        self.tree.add(self._index.files[file.path])
+        await self._release(old, self._index.files[file.path])
+        if with_save:
+            await self.save()
+    
+    async def cat_file(self, f: TelegramFile, write: typing.Callable[[bytes], typing.Awaitable], progres=lambda x, y: None, traffic_class: str = "interactive") -> None:
+        await self._backend.download_stream(f.msg_id, write, progres, traffic_class, f.chat)
+    
+    async def prefetch_file(self, file: abstract.File):
+        f = self._index.files.get(file.path)
+        if f is None:
+            raise exceptions.FileNotFound(f"No file {file.path} in index")
+        await self._backend.prefetch(f.msg_id, f.chat)
+    
+    async def get_file(self, file: abstract.File, traffic_class: str = "interactive"):
         f = self._index.files.get(file.path)
         if f is None:
             raise exceptions.FileNotFound(f"No file {file.path} in index")
-        await self._api.download_file(chat_id=self._chat_id, file_path=file.real_path, msg_id=f.msg_id, progres=file.progress)
+        await self._backend.download_file(file.real_path, f.msg_id, progres=file.progress, traffic_class=traffic_class, volume=f.chat)
+    
+    async def file_size(self, f: TelegramFile) -> int:
+        # files added by old versions have no size in index
+        if f.size or f.msg_id == 0:
+            return f.size
+        return await self._backend.file_size(f.msg_id, f.chat)
+    
+    async def read_range(self, f: TelegramFile, offset: int, limit: int) -> bytes:
+        return await self._backend.read_range(f.msg_id, offset, limit, volume=f.chat)
     
     async def remove_file(self, file: abstract.File, with_save: bool = True) -> None:
         f = self._index.files.get(file.path)
         if f is None:
             raise exceptions.FileNotFound(f"No file {file.path} in index")
-        await self._api.delete_msg(self._chat_id, f.msg_id)
+        if not self.is_retained(f):
+            await self._backend.delete_file(f.msg_id, f.chat)
         self._index.files.pop(file.path)
+        self._index.touch(file.path)
+        if self._tree is not None:
+            self._tree.remove(file.path)
         if with_save:
-            await self._index.save(self._client, self._chat_id, self._location)
+            await self.save()
+    
+    async def restore_file(self, f: TelegramFile, with_save: bool = True) -> None:
+        """Puts existing message back to index, e.g. from snapshot"""
+        old = self._index.files.get(f.path)
+        await self._release(old, f)
+        self._index.files[f.path] = f
+        self._index.touch(f.path)
+        if self._tree is not None:
+            self._tree.add(f)
+        if with_save:
+            await self.save()
+    
+    @property
+    def snapshots(self) -> dict[str, SnapshotInfo]:
+        return self._index.snapshots
+    
+    async def create_snapshot(self, name: str) -> SnapshotInfo:
+        if name in self._index.snapshots:
+            raise exceptions.CommandValidationError(f"Snapshot {name} already exists")
+        await self.load()
+        snapshot = FileSystemIndex(index_name=f"{self._index.index_name}@{name}", files=dict(self._index.files))
+        with tempfile.TemporaryDirectory() as tmp:
+            await snapshot.save(self._backend, os.path.join(tmp, "snapshot"))
+        for f in snapshot.files.values():
+            if f.msg_id != 0:
+                self._index.retained.setdefault(shard_key(f.path), {}).setdefault(f.key, []).append(name)
+                self._index.touch(f.path)
+        info = SnapshotInfo(
+            name=name, message_id=snapshot.message_id, created=time.time(), files_count=len(snapshot.files),
+            shard_ids=[shard.message_id for shard in snapshot.shards.values()]
+        )
+        self._index.snapshots[name] = info
+        await self.save()
+        return info
+    
+    async def load_snapshot(self, name: str) -> FileSystemIndex:
+        info = self._index.snapshots.get(name)
+        if info is None:
+            raise exceptions.FileNotFound(f"No snapshot {name}")
+        with tempfile.TemporaryDirectory() as tmp:
+            return await FileSystemIndex._get_by_id(self._backend, info.message_id, os.path.join(tmp, "snapshot"))
+    
+    async def delete_snapshot(self, name: str) -> None:
+        info = self._index.snapshots.pop(name, None)
+        if info is None:
+            raise exceptions.FileNotFound(f"No snapshot {name}")
+        await self.load()
+        live = {f.key for f in self._index.files.values()}
+        released = [file_key(info.message_id), *map(file_key, info.shard_ids)]
+        for shard, retained in list(self._index.retained.items()):
+            for key, names in list(retained.items()):
+                if name not in names:
+                    continue
+                names.remove(name)
+                self._index.touch_shard(shard)
+                if not names:
+                    retained.pop(key)
+                    if key not in live:
+                        released.append(key)
+            if not retained:
+                self._index.retained.pop(shard)
+        await asyncio.gather(*(self._backend.delete_file(*parse_file_key(key)) for key in released))
+        await self.save()
     
     async def save(self):
-        await self._index.save(self._client, self._chat_id, self._location)
+        await self._index.save(self._backend, self._location)
     
     def clone(self) -> "TelegramFileSystem":
-        return TelegramFileSystem(self._api, self._index.copy(), self._chat_id, self._client, self._location)
+        # index copy is shallow, so files and tree are shared with the clone
+        fs = TelegramFileSystem(self._backend, self._index.copy(), self._location)
+        fs._tree = self._tree
+        fs.lock = self.lock
+        return fs
     
-    def operation(self, max_inflight: int = 15) -> OperationCtx:
-        return OperationCtx(self.clone(), max_inflight)
+    def operation(self, max_inflight: int = 15, traffic_class: str = "interactive") -> OperationCtx:
+        return OperationCtx(self.clone(), max_inflight, traffic_class)
+
+
+class TelegramBackend(StorageBackend):
+    """
+    Stores files and documents as messages of telegram chats, file ids are message ids.
+
+    Documents are kept in chat of index, files are striped across `storage_chats` by
+    rendezvous hash of path, so adding a chat moves only files placed to it.
+    """
+    
+    def __init__(self, api: "TelegramApi", client: pyrogram.Client, chat_id: str | int, storage_chats: typing.Iterable[str] = ()) -> None:
+        self._api = api
+        self._client = client
+        self._chat_id = chat_id
+        self._storage_chats = list(storage_chats)
+        self._documents: dict[tuple[str | int, int], pyrogram.types.Document] = {}
+    
+    def _chat(self, volume: str | None) -> str | int:
+        return self._chat_id if volume is None else volume
+    
+    def place(self, path: str) -> str | None:
+        if not self._storage_chats:
+            return None
+        chat = max(self._storage_chats, key=lambda chat: hashlib.sha1(f"{chat}:{path}".encode()).digest())
+        return None if chat == str(self._chat_id) else chat
+    
+    async def upload_file(self, file: abstract.File, file_id: int | None = None, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        return await self._api.upload_file(self._chat(volume), file, msg_id=file_id, progres=progres, traffic_class=traffic_class)
+    
+    async def upload_stream(self, file: abstract.StreamFile, traffic_class: str = "interactive", volume: str | None = None) -> int:
+        return await self._api.upload_stream(self._chat(volume), file, traffic_class)
+    
+    async def download_file(self, file_path: str, file_id: int, progres=lambda x, y: None, traffic_class: str = "interactive", volume: str | None = None) -> None:
+        await self._api.download_file(chat_id=self._chat(volume), file_path=file_path, msg_id=file_id, progres=progres, traffic_class=traffic_class)
+    
+    @utils.retry(3)
+    async def copy_file(self, file_id: int, volume: str | None, to_volume: str | None, traffic_class: str = "background") -> int:
+        # message is copied by telegram, so file is not reuploaded
+        msg = await self._client.copy_message(chat_id=self._chat(to_volume), from_chat_id=self._chat(volume), message_id=file_id)
+        if msg is None:
+            raise exceptions.RetryableError(f"Cannot copy message {file_id}")
+        return msg.message_id
+    
+    async def delete_file(self, file_id: int, volume: str | None = None) -> None:
+        await self._api.delete_msg(self._chat(volume), file_id)
+    
+    async def prefetch(self, file_id: int, volume: str | None = None) -> None:
+        await self._api.prefetch_message(self._chat(volume), file_id)
+    
+    async def _document(self, file_id: int, volume: str | None, refresh: bool = False) -> pyrogram.types.Document:
+        key = (self._chat(volume), file_id)
+        if refresh or key not in self._documents:
+            msg = await self._api.get_message(*key)
+            if msg is None or msg.document is None:
+                raise exceptions.FileNotFound(f"No document in message {file_id} of telegram")
+            self._documents[key] = msg.document
+        return self._documents[key]
+    
+    async def read_range(self, file_id: int, offset: int, limit: int, traffic_class: str = "interactive", volume: str | None = None) -> bytes:
+        from pyrogram.errors import FileReferenceExpired
+        try:
+            return await self._api.read_range((await self._document(file_id, volume)).file_id, offset, limit, traffic_class)
+        except FileReferenceExpired:
+            document = await self._document(file_id, volume, refresh=True)
+            return await self._api.read_range(document.file_id, offset, limit, traffic_class)
+    
+    async def file_size(self, file_id: int, volume: str | None = None) -> int:
+        if file_id == 0:
+            return 0
+        return (await self._document(file_id, volume)).file_size
+    
+    @utils.retry(3)
+    async def find_document(self, caption: str, location: str) -> None:
+        # search is fuzzy, so shards `[name#dir]` and snapshots `[name@snapshot]` are found by the same query,
+        # there may be any number of them newer than manifest, so all results are paged through
+        async for res in self._client.search_messages(chat_id=self._chat_id, query=caption, filter="document"):
+            if res.caption == caption:
+                break
+        else:
+            raise WrongIndexException(f"Can not find document {caption}")
+        await self._client.download_media(res, location)
+    
+    @utils.retry(3)
+    async def load_document(self, doc_id: int, location: str) -> None:
+        res = await self._client.get_messages(chat_id=self._chat_id, message_ids=doc_id)
+        if res is None or res.document is None:
+            raise WrongIndexException(f"Can not find index in message {doc_id}")
+        await self._client.download_media(res, location)
+    
+    @utils.retry(3)
+    async def save_document(self, location: str, caption: str, doc_id: int = 0) -> int:
+        import pyrogram
+        if doc_id == 0:
+            msg = await self._client.send_document(chat_id=self._chat_id, document=location, caption=caption)
+            if msg is None:
+                raise exceptions.RetryableError("Cannot save index")
+            return msg.message_id
+        await self._client.edit_message_media(chat_id=self._chat_id, message_id=doc_id, media=pyrogram.types.InputMediaDocument(
+                media=location,
+                caption=caption
+            )
+        )
+        return doc_id
 
 
 class TelegramApi:
-    def __init__(self, client: pyrogram.Client) -> None:
+    GET_MESSAGES_LIMIT = 200
+    DELETE_MESSAGES_LIMIT = 100
+    # the same limits as pyrogram uses in Client.save_file
+    PART_SIZE = 512 * 1024
+    BIG_FILE_SIZE = 10 * 1024 * 1024
+    MAX_FILE_SIZE = 2000 * 1024 * 1024
+    STREAM_INFLIGHT_PARTS = 4
+    
+    def __init__(self, client: pyrogram.Client, shaper: shaping.Shaper | None = None) -> None:
         self._client = client
+        self._shaper = shaper if shaper is not None else shaping.shaper()
+        self._messages: dict[tuple[str | int, int], pyrogram.types.Message] = {}
+        self._get_batcher = utils.Batcher(self._get_messages, max_size=self.GET_MESSAGES_LIMIT)
+        self._delete_batcher = utils.Batcher(self._delete_messages, max_size=self.DELETE_MESSAGES_LIMIT)
+    
+    @utils.retry(3)
+    async def _get_messages(self, chat_id: str | int, msg_ids: list[int]) -> list[pyrogram.types.Message]:
+        return await self._client.get_messages(chat_id=chat_id, message_ids=msg_ids)
+    
+    @utils.retry(3)
+    async def _delete_messages(self, chat_id: str | int, msg_ids: list[int]) -> list[None]:
+        await self._client.delete_messages(chat_id=chat_id, message_ids=msg_ids)
+        return [None] * len(msg_ids)
+    
+    async def prefetch_message(self, chat_id: str | int, msg_id: int):
+        if msg_id == 0 or (chat_id, msg_id) in self._messages:
+            return
+        self._messages[(chat_id, msg_id)] = await self._get_batcher(chat_id, msg_id)
+    
+    async def get_message(self, chat_id: str | int, msg_id: int) -> pyrogram.types.Message:
+        msg = self._messages.pop((chat_id, msg_id), None)
+        if msg is None:
+            msg = await self._get_batcher(chat_id, msg_id)
+        return msg
         
     @utils.retry(3)
-    async def upload_file(self, chat_id: str | int, file: abstract.File, msg_id: int | None = None, progres=lambda x, y: None) -> int:
+    async def upload_file(self, chat_id: str | int, file: abstract.File, msg_id: int | None = None, progres=lambda x, y: None, traffic_class: str = "interactive") -> int:
+        import pyrogram
         if file.get_size() == 0:
             return 0
         
@@ -211,6 +824,8 @@ class TelegramApi:
             msg_id = None
         
         if msg_id is not None:
+            # edit_message_media has no progress callback, so whole file is paid before upload
+            await self._shaper.consume(traffic_class, "upload", file.get_size())
             msg = await self._client.edit_message_media(
                 chat_id=chat_id,
                 message_id=msg_id,
@@ -225,27 +840,163 @@ class TelegramApi:
             document=file.real_path,
             file_name=file.name,
             force_document=True,
-            progress=progres
+            progress=self._shaper.progress(traffic_class, "upload", progres)
         )
         if msg is None:
             raise exceptions.RetryableError(f"Cannot upload file {file.name}")
         return msg.message_id
     
     @utils.retry(3)
-    async def download_file(self, chat_id: str | int, file_path: str, msg_id: int, progres=lambda x, y: None):
+    async def _save_part(self, session, rpc):
+        if not await session.send(rpc):
+            raise exceptions.RetryableError("Cannot upload file part")
+    
+    async def upload_stream(self, chat_id: str | int, file: abstract.StreamFile, traffic_class: str = "interactive") -> int:
+        """
+        Uploads stream of unknown size with parts of raw api.
+
+        Up to 10 MiB is buffered to find out if file is small. Big files are sent with unknown
+        count of parts, it is given only with the last part, so one part is held back.
+        """
+        from pyrogram import raw
+        session = await self._media_session(await self._client.storage.dc_id())
+        upload_id = self._client.rnd_id()
+        semaphore = asyncio.Semaphore(self.STREAM_INFLIGHT_PARTS)
+        tasks: set[asyncio.Task] = set()
+        
+        async def send(rpc):
+            try:
+                await self._save_part(session, rpc)
+            finally:
+                semaphore.release()
+        
+        async def put(rpc, size: int):
+            await self._shaper.consume(traffic_class, "upload", size)
+            await semaphore.acquire()
+            for done in [task for task in tasks if task.done()]:
+                tasks.discard(done)
+                done.result()
+            tasks.add(asyncio.create_task(send(rpc)))
+        
+        chunks = file.chunks(self.PART_SIZE)
+        head: list[bytes] = []
+        size = 0
+        try:
+            async for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size > self.BIG_FILE_SIZE:
+                    break
+            if size == 0:
+                return 0
+            if size <= self.BIG_FILE_SIZE:
+                for part, chunk in enumerate(head):
+                    await put(raw.functions.upload.SaveFilePart(file_id=upload_id, file_part=part, bytes=chunk), len(chunk))
+                input_file = raw.types.InputFile(id=upload_id, parts=len(head), name=file.name, md5_checksum="")
+            else:
+                part = 0
+                held = head.pop(0)
+                async def rest():
+                    for chunk in head:
+                        yield chunk
+                    async for chunk in chunks:
+                        yield chunk
+                async for chunk in rest():
+                    await put(raw.functions.upload.SaveBigFilePart(file_id=upload_id, file_part=part, file_total_parts=-1, bytes=held), len(held))
+                    part, held = part + 1, chunk
+                    if (part + 1) * self.PART_SIZE > self.MAX_FILE_SIZE:
+                        raise exceptions.CommandValidationError("Telegram does not support files bigger than 2000 MiB")
+                await put(raw.functions.upload.SaveBigFilePart(file_id=upload_id, file_part=part, file_total_parts=part + 1, bytes=held), len(held))
+                input_file = raw.types.InputFileBig(id=upload_id, parts=part + 1, name=file.name)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        r = await self._client.send(raw.functions.messages.SendMedia(
+            peer=await self._client.resolve_peer(chat_id),
+            media=raw.types.InputMediaUploadedDocument(
+                mime_type="application/octet-stream",
+                file=input_file,
+                attributes=[raw.types.DocumentAttributeFilename(file_name=file.name)]
+            ),
+            message="",
+            random_id=self._client.rnd_id()
+        ))
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return update.message.id
+        raise exceptions.RetryableError(f"Cannot upload file {file.name}")
+    
+    async def _media_session(self, dc_id: int):
+        # the same session setup pyrogram does in Client.get_file, which can only download whole files
+        from pyrogram import raw
+        from pyrogram.session import Auth, Session
+        from pyrogram.errors import AuthBytesInvalid
+        client = self._client
+        async with client.media_sessions_lock:
+            session = client.media_sessions.get(dc_id)
+            if session is not None:
+                return session
+            test_mode = await client.storage.test_mode()
+            if dc_id == await client.storage.dc_id():
+                session = Session(client, dc_id, await client.storage.auth_key(), test_mode, is_media=True)
+                await session.start()
+            else:
+                session = Session(client, dc_id, await Auth(client, dc_id, test_mode).create(), test_mode, is_media=True)
+                await session.start()
+                for _ in range(3):
+                    exported_auth = await client.send(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                    try:
+                        await session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
+                    except AuthBytesInvalid:
+                        continue
+                    break
+                else:
+                    await session.stop()
+                    raise AuthBytesInvalid
+            client.media_sessions[dc_id] = session
+            return session
+    
+    @utils.retry(3)
+    async def read_range(self, file_id: str, offset: int, limit: int, traffic_class: str = "interactive") -> bytes:
+        """Reads part of document. Limit must divide 1 MiB and offset must be aligned to limit"""
+        await self._shaper.consume(traffic_class, "download", limit)
+        from pyrogram import raw
+        from pyrogram.file_id import FileId
+        decoded = FileId.decode(file_id)
+        session = await self._media_session(decoded.dc_id)
+        r = await session.send(
+            raw.functions.upload.GetFile(
+                location=raw.types.InputDocumentFileLocation(
+                    id=decoded.media_id,
+                    access_hash=decoded.access_hash,
+                    file_reference=decoded.file_reference,
+                    thumb_size=decoded.thumbnail_size
+                ),
+                offset=offset,
+                limit=limit
+            ),
+            sleep_threshold=30
+        )
+        if not isinstance(r, raw.types.upload.File):
+            raise NotImplementedError("Reading files redirected to CDN is not supported")
+        return r.bytes
+    
+    @utils.retry(3)
+    async def download_file(self, chat_id: str | int, file_path: str, msg_id: int, progres=lambda x, y: None, traffic_class: str = "interactive"):
         if msg_id == 0:
             if not os.path.exists(file_path):
                 open(file_path, 'x').close()
             return
-        msg = await self._client.get_messages(chat_id=chat_id, message_ids=msg_id)
+        msg = await self.get_message(chat_id, msg_id)
         await self._client.download_media(
             msg,
             file_name=file_path,
-            progress=progres
+            progress=self._shaper.progress(traffic_class, "download", progres)
         )
     
-    @utils.retry(3)
     async def delete_msg(self, chat_id: str | int, msg_id: int) -> None:
         if msg_id == 0:
             return
-        await self._client.delete_messages(chat_id=chat_id, message_ids=msg_id)
\ No newline at end of file
+        await self._delete_batcher(chat_id, msg_id)
\ No newline at end of file
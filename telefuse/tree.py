@@ -0,0 +1,93 @@
+from __future__ import annotations
+import typing
+
+if typing.TYPE_CHECKING:
+    from .telegram import TelegramFile
+
+
+def split_path(path: str) -> list[str]:
+    return [part for part in path.split("/") if part not in ("", ".")]
+
+
+class DirNode:
+    """Directory of remote index, keeps sizes and counts aggregated over whole subtree"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.dirs: dict[str, DirNode] = {}
+        self.files: dict[str, TelegramFile] = {}
+        self.size: int = 0
+        self.count: int = 0
+
+    def walk(self) -> typing.Iterator[TelegramFile]:
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield from node.files.values()
+            stack.extend(node.dirs.values())
+
+
+class IndexTree:
+
+    def __init__(self) -> None:
+        self.root = DirNode("")
+
+    @classmethod
+    def from_files(cls, files: dict[str, TelegramFile]) -> "IndexTree":
+        tree = cls()
+        for f in files.values():
+            tree.add(f)
+        return tree
+
+    def _parents(self, parts: list[str], create: bool = False) -> list[DirNode] | None:
+        nodes = [self.root]
+        for part in parts:
+            node = nodes[-1].dirs.get(part)
+            if node is None:
+                if not create:
+                    return None
+                node = nodes[-1].dirs[part] = DirNode(part)
+            nodes.append(node)
+        return nodes
+
+    def add(self, f: TelegramFile):
+        self.remove(f.path)
+        *dirs, name = split_path(f.path)
+        nodes = self._parents(dirs, create=True)
+        nodes[-1].files[name] = f
+        for node in nodes:
+            node.size += f.size
+            node.count += 1
+
+    def remove(self, path: str) -> TelegramFile | None:
+        *dirs, name = split_path(path)
+        nodes = self._parents(dirs)
+        if nodes is None or name not in nodes[-1].files:
+            return None
+        f = nodes[-1].files.pop(name)
+        for node in nodes:
+            node.size -= f.size
+            node.count -= 1
+        for parent, node in zip(reversed(nodes[:-1]), reversed(nodes[1:])):
+            if node.count or node.dirs:
+                break
+            parent.dirs.pop(node.name)
+        return f
+
+    def find(self, path: str) -> DirNode | TelegramFile | None:
+        parts = split_path(path)
+        if not parts:
+            return self.root
+        nodes = self._parents(parts[:-1])
+        if nodes is None:
+            return None
+        return nodes[-1].dirs.get(parts[-1]) or nodes[-1].files.get(parts[-1])
+
+    def walk(self, path: str = "") -> typing.Iterator[TelegramFile]:
+        node = self.find(path)
+        if node is None:
+            return
+        if isinstance(node, DirNode):
+            yield from node.walk()
+        else:
+            yield node
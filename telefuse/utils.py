@@ -1,6 +1,6 @@
+import asyncio
 import functools
 import typing
-from pyrogram.errors import RPCError, MessageNotModified
 import time
 from . import exceptions
 
@@ -8,7 +8,7 @@ import hashlib
 
 
 # Print iterations progress
-def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
+def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r", file = None):
     """
     Call in a loop to create terminal progress bar
     @params:
@@ -20,20 +20,20 @@ def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1,
         length      - Optional  : character length of bar (Int)
         fill        - Optional  : bar fill character (Str)
         printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
+        file        - Optional  : stream to print to, stdout by default (TextIO)
     """
+    if total == 0:
+        iteration = total = 1
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filledLength = int(length * iteration // total)
     bar = fill * filledLength + '-' * (length - filledLength)
-    print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd)
+    print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd, file = file)
     # Print New Line on Complete
     if iteration == total: 
-        print()
+        print(file = file)
 
 
 def retry(max_num: int, allowed_errors: list[typing.Type[Exception]] = None, sleep_time:float = 1):
-    if allowed_errors is None:
-        retryeble = [RPCError, exceptions.RetryableError]
-    allowed = [MessageNotModified]
     def decorator(f: typing.Callable[..., typing.Awaitable]):
         @functools.wraps(f)
         async def wrapper(*args, **kwargs):
@@ -41,17 +41,78 @@ def retry(max_num: int, allowed_errors: list[typing.Type[Exception]] = None, sle
                 try:
                     return await f(*args, **kwargs)
                 except Exception as e:
+                    # pyrogram is imported lazily, only wrapped api calls can raise its errors
+                    from pyrogram.errors import RPCError, MessageNotModified, FloodWait
+                    retryeble = [RPCError, exceptions.RetryableError] if allowed_errors is None else allowed_errors
+                    allowed = [MessageNotModified]
                     if type(e) in allowed:
                         return
-                    if type(e) not in retryeble:
-                        raise e
                     if i == max_num - 1:
                         raise e
+                    if isinstance(e, FloodWait):
+                        # waits longer than threshold of pyrogram come here
+                        await asyncio.sleep(e.x)
+                        continue
+                    if type(e) not in retryeble:
+                        raise e
                     time.sleep(sleep_time)
         return wrapper
     return decorator
 
 
+class Batcher:
+    """
+    Merges single-id calls made concurrently into calls of `func(key, ids)`.
+
+    Ids are collected for `window` seconds or until `max_size` of them is queued,
+    `func` must return results in the same order as ids. At most `max_inflight` calls
+    of `func` run at once, so many full batches do not flood telegram.
+    """
+    def __init__(self, func: typing.Callable[[typing.Any, list[int]], typing.Awaitable[list[typing.Any]]], max_size: int, window: float = 0.05, max_inflight: int = 3) -> None:
+        self._func = func
+        self._max_size = max_size
+        self._window = window
+        self._semaphore = asyncio.Semaphore(max_inflight)
+        self._pending: dict[typing.Any, list[tuple[int, asyncio.Future]]] = {}
+        self._timers: dict[typing.Any, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+    
+    async def __call__(self, key: typing.Any, item_id: int) -> typing.Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((item_id, future))
+        if len(pending) >= self._max_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self._window, self._flush, key)
+        return await future
+    
+    def _flush(self, key: typing.Any):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            task = asyncio.create_task(self._run(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, key: typing.Any, batch: list[tuple[int, asyncio.Future]]):
+        ids = list(dict.fromkeys(item_id for item_id, _ in batch))
+        try:
+            async with self._semaphore:
+                results = dict(zip(ids, await self._func(key, ids)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for item_id, future in batch:
+            if not future.done():
+                future.set_result(results.get(item_id))
+
+
 def hash_file(filename: str) -> str:
    """"This function returns the SHA-1 hash
    of the file passed into it"""
@@ -70,4 +131,12 @@ def hash_file(filename: str) -> str:
            h.update(chunk)
 
    # return the hex representation of digest
-   return h.hexdigest()
\ No newline at end of file
+   return h.hexdigest()
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "K", "M", "G", "T"):
+        if size < 1024 or unit == "T":
+            break
+        size /= 1024
+    return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
@@ -1,17 +1,19 @@
 from . import telegram
 from . import config
 from . import abstract
-import os
+from . import ignore
 import asyncio
 from asyncinotify import Inotify, Mask
 import typing
 
 class Wather:
-    def __init__(self, fs: telegram.TelegramFileSystem, file_factory: typing.Callable[[str], abstract.File], period_time: float = 20) -> None:
-        self.operation: telegram.OperationCtx = fs.operation()
+    def __init__(self, fs: telegram.TelegramFileSystem, file_factory: typing.Callable[[str], abstract.File], matcher: ignore.IgnoreMatcher | None = None, period_time: float = 20) -> None:
+        self.operation: telegram.OperationCtx = fs.operation(traffic_class="background")
         self.fs = fs
         self.file_factory = file_factory
-        self.lock = asyncio.Lock()
+        self.matcher = matcher if matcher is not None else ignore.IgnoreMatcher([])
+        # the same lock guards all changes of fs, e.g. batches of daemon and moves of backend
+        self.lock = fs.lock
         self.stop_event = asyncio.Event()
         self.period_time = period_time
         self.wather: asyncio.Task | None = None
@@ -20,12 +22,13 @@ class Wather:
     async def wather_coro(self, main_dir: str, fs_config: config.FsConfig):
         files = set(self.fs.files)
         with Inotify() as inotify:
-            for dirname, _, _ in os.walk(main_dir):
-                inotify.add_watch(os.path.abspath(dirname), Mask.MODIFY | Mask.DELETE)
+            for dirname in (await asyncio.to_thread(ignore.scan, main_dir, fs_config.dir_path, self.matcher))[1]:
+                inotify.add_watch(dirname, Mask.MODIFY | Mask.DELETE)
             async for event in inotify:
                 if event.path is None:
                     continue
-                if fs_config.get_path(event.path.absolute().as_posix()) not in files:
+                path = fs_config.get_path(event.path.absolute().as_posix())
+                if path not in files or self.matcher.is_ignored(path):
                     continue
                 async with self.lock:
                     print(event)
@@ -39,11 +42,13 @@ class Wather:
         while True:
             async with self.lock:
                 print("Uploading")
+                await self.fs.refresh()
                 await self.operation.save()
             try:
                 await asyncio.wait_for(self.stop_event.wait(), self.period_time)
                 async with self.lock:   
                     print("Uploading")
+                    await self.fs.refresh()
                     await self.operation.save()
                 break
             except asyncio.TimeoutError:
@@ -54,11 +59,11 @@ class Wather:
         if self.main is not None:
             await self.main
         if self.wather is not None:
+            self.wather.cancel()
             try:
-                self.wather.cancel()
+                await self.wather
             except asyncio.CancelledError:
                 pass
-            await self.wather
         
     
     async def start_and_wait(self, main_dir: str, fs_config: config.FsConfig):